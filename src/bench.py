@@ -0,0 +1,677 @@
+"""
+Benchmarks of the data pipeline and the model.
+Usage: python bench.py <benchmark> [options]
+"""
+from argparse import ArgumentParser
+import multiprocessing
+import os
+import time
+import numpy as np
+
+
+def timeit(fn, repeat):
+    """Return the mean seconds of `repeat` calls of fn()"""
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+class _StubSong:
+    """A song with `lgth` segments and no data, isolates the indexing overhead"""
+    song_fn = "stub"
+
+    def __init__(self, lgth):
+        self.lgth = lgth
+
+    def __len__(self):
+        return self.lgth
+
+    def __getitem__(self, idx):
+        return idx, idx
+
+
+def bench_index_lookup(args):
+    """Per-item overhead of PianoOrchDataset index lookup against corpus size"""
+    from dataset import PianoOrchDataset
+
+    def legacy_getitem(dataset, index):
+        # the lookup used before the searchsorted index
+        song_no = np.where(dataset.lgth_cumsum > index)[0][0]
+        song_item = index - np.insert(dataset.lgth_cumsum, 0, 0)[song_no]
+        return dataset.data_samples[song_no][song_item]
+
+    rng = np.random.default_rng(0)
+    print(
+        f"{'songs':>8} {'segments':>10} {'legacy us/item':>15} "
+        f"{'getitem us/item':>16} {'getitems us/item':>17}"
+    )
+    for num_songs in args.num_songs:
+        lgths = rng.integers(1, 60, num_songs)
+        dataset = PianoOrchDataset([_StubSong(lgth) for lgth in lgths])
+        indices = rng.integers(0, len(dataset), args.batch_size)
+
+        legacy = timeit(
+            lambda: [legacy_getitem(dataset, i) for i in indices], args.repeat
+        )
+        single = timeit(lambda: [dataset[i] for i in indices], args.repeat)
+        batched = timeit(lambda: dataset.__getitems__(indices), args.repeat)
+        print(
+            f"{num_songs:>8} {len(dataset):>10} "
+            f"{legacy / args.batch_size * 1e6:>15.2f} "
+            f"{single / args.batch_size * 1e6:>16.2f} "
+            f"{batched / args.batch_size * 1e6:>17.2f}"
+        )
+
+
+def current_rss():
+    """Resident set size of this process in bytes (Linux)"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _load_songs(sample_cls_name, song_fns):
+    import dataset
+
+    sample_cls = getattr(dataset, sample_cls_name)
+    rss = current_rss()
+    start = time.perf_counter()
+    songs = [sample_cls(song_fn) for song_fn in song_fns]
+    load_time = time.perf_counter() - start
+    rss = current_rss() - rss
+    start = time.perf_counter()
+    for song in songs:
+        for i in range(len(song)):
+            song[i]
+    seg_time = time.perf_counter() - start
+    return load_time, rss, seg_time
+
+
+def bench_song_format(args):
+    """Load time and RSS of songs in the npz format against the compact format"""
+    from dataset import COMPACT_FN
+    from dirs import DATA_DIR
+
+    song_fns = sorted(os.listdir(DATA_DIR))
+    song_fns = [
+        song_fn for song_fn in song_fns
+        if os.path.exists(os.path.join(DATA_DIR, song_fn, COMPACT_FN))
+    ][: args.num_songs]
+    print(f"{len(song_fns)} songs converted to the compact format")
+
+    # each format is loaded in a fresh process so that RSS deltas are comparable
+    ctx = multiprocessing.get_context("spawn")
+    for sample_cls_name in ["DataSampleNpz", "DataSampleCompact"]:
+        with ctx.Pool(1) as pool:
+            load_time, rss, seg_time = pool.apply(
+                _load_songs, (sample_cls_name, song_fns)
+            )
+        print(
+            f"{sample_cls_name:>18}: load {load_time:.3f}s, "
+            f"RSS +{rss / 2**20:.1f}MiB, all segments {seg_time:.3f}s"
+        )
+
+
+def bench_sampler(args):
+    """Training step time with the random sampler against the bucket sampler"""
+    import torch
+    from dataloader import get_train_val_dataloaders
+    from model import Diffpro
+    from params import params
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = Diffpro(params).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=params.learning_rate)
+    for bucket_sampler in [False, True]:
+        params.override({"bucket_sampler": bucket_sampler})
+        train_dl, _ = get_train_val_dataloaders(args.batch_size, params)
+        step_times = []
+        for i, (pnotree_x, pnotree_y) in enumerate(train_dl):
+            if i == args.num_steps:
+                break
+            pnotree_x, pnotree_y = pnotree_x.to(device), pnotree_y.to(device)
+            start = time.perf_counter()
+            optimizer.zero_grad()
+            loss = model.get_loss_dict(pnotree_x, pnotree_y)["loss"]
+            loss.backward()
+            optimizer.step()
+            if device == "cuda":
+                torch.cuda.synchronize()
+            step_times.append(time.perf_counter() - start)
+        print(
+            f"bucket_sampler={bucket_sampler}: "
+            f"{np.mean(step_times[1:]) * 1e3:.1f}ms/step over {len(step_times)} steps"
+        )
+
+
+def _legacy_nmat_to_pianotree_repr(nmat, n_step=32, max_note_count=20):
+    """The per-note loop that nmat_to_pianotree_repr replaced"""
+    pnotree = np.ones((n_step, max_note_count, 6), dtype=np.int64) * 2
+    pnotree[:, :, 0] = 130
+    pnotree[:, 0, 0] = 128
+    cur_idx = np.ones(n_step, dtype=np.int64)
+    for o, p, d in nmat:
+        pnotree[o, cur_idx[o], 0] = p
+        d = min(d, 32)
+        bin_str = np.binary_repr(int(d) - 1, width=5)
+        pnotree[o, cur_idx[o], 1 :] = [int(c) for c in bin_str]
+        if cur_idx[o] < max_note_count - 1:
+            cur_idx[o] += 1
+    pnotree[np.arange(0, n_step), cur_idx, 0] = 129
+    return pnotree
+
+
+def bench_pianotree_repr(args):
+    """The per-note loop against nmat(s)_to_pianotree_repr, asserting equal output"""
+    import contextlib
+    import io
+    from utils import nmat_to_pianotree_repr, nmats_to_pianotree_repr
+
+    rng = np.random.default_rng(0)
+    nmats = []
+    for i in range(args.num_segs):
+        # empty, sparse, and dense segments whose steps overflow max_note_count
+        num_notes = [0, 10, 120, 600][i % 4]
+        nmats.append(
+            np.stack(
+                [
+                    rng.integers(0, 32, num_notes),
+                    rng.integers(0, 128, num_notes),
+                    rng.integers(1, 40, num_notes),
+                ], axis=1
+            )
+        )
+    # overflowing segments print a warning per segment
+    with contextlib.redirect_stdout(io.StringIO()):
+        legacy = np.stack([_legacy_nmat_to_pianotree_repr(nmat) for nmat in nmats])
+        single = np.stack([nmat_to_pianotree_repr(nmat) for nmat in nmats])
+        batched = nmats_to_pianotree_repr(nmats)
+        assert (legacy == single).all() and (legacy == batched).all()
+        times = [
+            (
+                "loop",
+                timeit(lambda: [_legacy_nmat_to_pianotree_repr(m) for m in nmats], 1)
+            ),
+            ("single", timeit(lambda: [nmat_to_pianotree_repr(m) for m in nmats], 1)),
+            ("batched", timeit(lambda: nmats_to_pianotree_repr(nmats), 1)),
+        ]
+    print(f"outputs equal on {args.num_segs} segments")
+    for name, seconds in times:
+        print(f"{name:>8}: {seconds * 1e3:.1f}ms")
+
+
+def _legacy_estx_to_midi_file(est_x, fpath, labels=None):
+    """The pretty_midi writer that estx_to_midi_file replaced"""
+    import pretty_midi as pm
+
+    midi = pm.PrettyMIDI()
+    piano_program = pm.instrument_name_to_program("Acoustic Grand Piano")
+    piano = pm.Instrument(program=piano_program)
+    t = 0
+    for two_bars in est_x:
+        for step_ind, step in enumerate(two_bars):
+            for kth_key in step:
+                if not (kth_key[0] >= 0 and kth_key[0] <= 127):
+                    continue
+                dur = (
+                    kth_key[5] + (kth_key[4] << 1) + (kth_key[3] << 2) +
+                    (kth_key[2] << 3) + (kth_key[1] << 4) + 1
+                )
+                note = pm.Note(
+                    velocity=80,
+                    pitch=int(kth_key[0]),
+                    start=t + step_ind * 1 / 8,
+                    end=min(t + (step_ind + int(dur)) * 1 / 8, t + 4),
+                )
+                piano.notes.append(note)
+        t += 4
+    midi.instruments.append(piano)
+    if labels is not None:
+        midi.lyrics.clear()
+        t = 0
+        for label in labels:
+            midi.lyrics.append(pm.Lyric(label, t))
+            t += 4
+    midi.write(fpath)
+
+
+def bench_midi(args):
+    """
+    The pretty_midi writer against estx_to_midi_file and MidiStreamWriter, asserting
+    byte-identical files
+    """
+    import tempfile
+    from utils import MidiStreamWriter, estx_to_midi_file
+
+    def read(fpath):
+        with open(fpath, "rb") as f:
+            return f.read()
+
+    rng = np.random.default_rng(0)
+    # sos, eos and pad keys (rests) among the pitches
+    pitches = np.r_[np.arange(128), [128, 129, 130] * 20]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        legacy_fpath = os.path.join(tmp_dir, "legacy.mid")
+        fpath = os.path.join(tmp_dir, "x.mid")
+        for case in range(args.num_cases):
+            # empty songs first, then up to max_segs segments
+            num_segs = 0 if case < 2 else int(rng.integers(1, args.max_segs + 1))
+            est_x = np.zeros((num_segs, 32, 19, 6), dtype=np.int64)
+            est_x[..., 0] = rng.choice(pitches, size=(num_segs, 32, 19))
+            # pad duration bits (2) in every third case
+            max_bit = 2 if case % 3 == 0 else 1
+            est_x[..., 1 :] = rng.integers(0, max_bit + 1, (num_segs, 32, 19, 5))
+            if case % 2 == 1:
+                # eos from the third key on, as decoded
+                est_x[:, :, 3 :, 0] = 129
+            labels = [f"l{i}" for i in range(num_segs)] if case % 4 == 0 else None
+
+            _legacy_estx_to_midi_file(est_x, legacy_fpath, labels)
+            legacy = read(legacy_fpath)
+            estx_to_midi_file(est_x, fpath, labels)
+            assert read(fpath) == legacy, f"case {case}: estx_to_midi_file"
+            for chunk_size in args.chunk_sizes:
+                with MidiStreamWriter(fpath, labels) as writer:
+                    for start in range(0, num_segs, chunk_size):
+                        writer.append_estx(est_x[start : start + chunk_size])
+                assert read(fpath) == legacy, (
+                    f"case {case}: MidiStreamWriter, chunk_size={chunk_size}"
+                )
+        print(
+            f"files equal on {args.num_cases} cases, streamed at chunk sizes "
+            f"{args.chunk_sizes}"
+        )
+
+        est_x = np.zeros((args.max_segs, 32, 19, 6), dtype=np.int64)
+        est_x[..., 0] = rng.choice(pitches, size=est_x.shape[:-1])
+        est_x[..., 1 :] = rng.integers(0, 2, est_x[..., 1 :].shape)
+        times = [
+            ("pretty_midi", timeit(lambda: _legacy_estx_to_midi_file(est_x, fpath), 1)),
+            ("numpy", timeit(lambda: estx_to_midi_file(est_x, fpath), 1)),
+        ]
+    for name, seconds in times:
+        print(f"{name:>11}: {seconds * 1e3:.1f}ms at {len(est_x)} segments")
+
+
+def random_pnotree(batch_size, seed=0):
+    """Random (batch_size, 32, 20, 6) pianotrees of valid notes"""
+    import torch
+    from utils import nmats_to_pianotree_repr
+
+    rng = np.random.default_rng(seed)
+    nmats = []
+    for _ in range(batch_size):
+        num_notes = rng.integers(0, 120)
+        nmats.append(
+            np.stack(
+                [
+                    rng.integers(0, 32, num_notes),
+                    rng.integers(21, 109, num_notes),
+                    rng.integers(1, 33, num_notes),
+                ], axis=1
+            )
+        )
+    return torch.from_numpy(nmats_to_pianotree_repr(nmats))
+
+
+def peak_memory(fn, device):
+    """Peak bytes allocated by torch while running fn()"""
+    import torch
+
+    if device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        fn()
+        return torch.cuda.max_memory_allocated() - base
+    with torch.profiler.profile(profile_memory=True) as prof:
+        fn()
+    # running sum of allocations and frees, in event order
+    usage = 0
+    peak = 0
+    for event in sorted(prof.events(), key=lambda e: e.time_range.start):
+        usage += event.self_cpu_memory_usage
+        peak = max(peak, usage)
+    return peak
+
+
+def bench_embedding(args):
+    """Multi-hot note embedding against the fused embedding lookup"""
+    import torch
+    from dl_modules import PianoTreeEncoder
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    enc = PianoTreeEncoder(device).to(device)
+    pnotree = random_pnotree(args.batch_size).to(device)
+    with torch.no_grad():
+        multihot = enc.note_embedding(enc.index_tensor_to_multihot_tensor(pnotree))
+        fused = enc.embed_index_tensor(pnotree)
+    print(f"max abs difference: {(multihot - fused).abs().max().item():.3e}")
+    assert torch.allclose(multihot, fused, atol=1e-5)
+
+    def sync():
+        if device == "cuda":
+            torch.cuda.synchronize()
+
+    paths = {
+        "multihot": lambda: enc.note_embedding(enc.index_tensor_to_multihot_tensor(
+            pnotree
+        )),
+        "fused": lambda: enc.embed_index_tensor(pnotree),
+    }
+    with torch.no_grad():
+        for name, fn in paths.items():
+            step_time = timeit(lambda: (fn(), sync()), args.repeat)
+            peak = peak_memory(fn, device)
+            print(
+                f"{name:>9}: {step_time * 1e3:.2f}ms, "
+                f"peak {peak / 2**20:.1f}MiB at batch_size={args.batch_size}"
+            )
+
+
+def bench_pack_free(args):
+    """Packed against pack-free (masked) note GRUs of the encoder and decoder"""
+    import torch
+    from dl_modules import PianoTreeEncoder, PianoTreeDecoder
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    enc = PianoTreeEncoder(device).to(device)
+    dec = PianoTreeDecoder(device).to(device)
+    pnotree = random_pnotree(args.batch_size).to(device)
+
+    def sync():
+        if device == "cuda":
+            torch.cuda.synchronize()
+
+    def encode():
+        return enc(pnotree)[0].mean
+
+    def summarize():
+        return dec.summarize_x(*dec.emb_x(pnotree))
+
+    with torch.no_grad():
+        outputs = {}
+        for pack_free in [False, True]:
+            enc.pack_free = dec.pack_free = pack_free
+            name = "pack-free" if pack_free else "packed"
+            outputs[pack_free] = encode(), summarize()
+            for part, fn in [("encoder", encode), ("summarize_x", summarize)]:
+                step_time = timeit(lambda: (fn(), sync()), args.repeat)
+                print(
+                    f"{name:>9} {part:>11}: {step_time * 1e3:.2f}ms "
+                    f"at batch_size={args.batch_size}"
+                )
+    for part, packed, masked in zip(["mu", "x_summarized"], *outputs.values()):
+        print(f"{part} max abs difference: {(packed - masked).abs().max():.3e}")
+        assert torch.allclose(packed, masked, atol=1e-5), part
+
+
+def _first_eos_mask(est_pitch, pitch_eos):
+    """Note positions up to and including the first eos of each step"""
+    eos = (est_pitch == pitch_eos).astype(np.int64)
+    return np.cumsum(eos, axis=-1) - eos == 0
+
+
+def bench_note_decoding(args):
+    """
+    Inference latency per segment of padded note decoding, the default decoding
+    paths (asserting equal est_x), and the opt-in cell loops and early exit
+    """
+    import pickle
+    import torch
+    from dataset import open_data_sample
+    from dirs import PT_PNOTREE_PATH, TRAIN_SPLIT_DIR
+    from model import Diffpro
+    from params import params
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if args.model_dir is not None:
+        model = Diffpro.load_trained(args.model_dir, params)
+    else:
+        model = Diffpro(params, pt_pnotree_model_path=PT_PNOTREE_PATH)
+    model = model.to(device).eval()
+    with open(os.path.join(TRAIN_SPLIT_DIR, "split_dict.pickle"), "rb") as f:
+        valid_fns = pickle.load(f)[1][: args.num_songs]
+
+    # (early_exit, cell_loops) of each mode
+    modes = {
+        "padded": (False, False),
+        "default": (params.dec_early_exit, params.dec_cell_loops),
+        "cell-loops": (False, True),
+        "early-exit": (True, False),
+    }
+    seg_times = {name: [] for name in modes}
+    pitch_eos = model.pnotree_dec.pitch_eos
+    for song_fn in valid_fns:
+        pnotree_x, _ = open_data_sample(song_fn).get_whole_song_data()
+        pnotree_x = pnotree_x.to(device)
+        est_x = {}
+        for name, (early_exit, cell_loops) in modes.items():
+            model.pnotree_dec.early_exit = early_exit
+            model.pnotree_dec.cell_loops = cell_loops
+            start = time.perf_counter()
+            est_x[name], _, _ = model.infer(pnotree_x)
+            seg_times[name].append((time.perf_counter() - start) / len(pnotree_x))
+        assert (est_x["default"] == est_x["padded"]).all(), song_fn
+        # early exit decodes the notes before the first eos identically, and
+        # changes the keys after it
+        mask = _first_eos_mask(est_x["padded"][..., 0], pitch_eos)
+        assert (est_x["padded"][mask] == est_x["early-exit"][mask]).all(), song_fn
+        changed = (est_x["padded"] != est_x["early-exit"]).any(-1).sum()
+        # float rounding of the cell loops may flip tied argmaxes
+        cell_changed = (est_x["padded"] != est_x["cell-loops"]).any(-1).sum()
+        times = ", ".join(
+            f"{name} {seg_time[-1] * 1e3:.2f}ms" for name, seg_time in seg_times.items()
+        )
+        print(
+            f"{song_fn}: {len(pnotree_x)} segments, {times} per segment, "
+            f"{changed} keys after eos changed by early exit, "
+            f"{cell_changed} keys changed by cell loops"
+        )
+    padded = np.mean(seg_times["padded"])
+    print(
+        "mean per segment: " + ", ".join(
+            f"{name} {np.mean(seg_time) * 1e3:.2f}ms "
+            f"({padded / np.mean(seg_time):.2f}x)"
+            for name, seg_time in seg_times.items()
+        )
+    )
+
+
+def count_allocations(fn, device):
+    """
+    Number of tensor allocations on device while running fn(), and of host to
+    device copies if device is "cuda" (None otherwise)
+    """
+    import torch
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if device == "cuda":
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with torch.profiler.profile(activities=activities, profile_memory=True) as prof:
+        fn()
+    events = prof.events()
+    if device == "cuda":
+        allocs = sum(event.self_cuda_memory_usage > 0 for event in events)
+        copies = sum("Memcpy HtoD" in event.name for event in events)
+        return allocs, copies
+    return sum(event.self_cpu_memory_usage > 0 for event in events), None
+
+
+def bench_decoding_allocs(args):
+    """Allocations, copies and time of one PianoTreeDecoder call"""
+    import torch
+    from dl_modules import PianoTreeDecoder
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    torch.manual_seed(0)
+    dec = PianoTreeDecoder(device).to(device)
+    z = torch.randn(args.batch_size, dec.z_size, device=device)
+    embedded, lengths = dec.emb_x(random_pnotree(args.batch_size).to(device))
+
+    def sync():
+        if device == "cuda":
+            torch.cuda.synchronize()
+
+    modes = {
+        "inference": lambda: dec(z, True, None, None, 0, 0),
+        "training": lambda: dec(z, False, embedded, lengths, 0.5, 0.5),
+    }
+    with torch.no_grad():
+        for name, fn in modes.items():
+            allocs, copies = count_allocations(fn, device)
+            step_time = timeit(lambda: (fn(), sync()), args.repeat)
+            copies = "" if copies is None else f", {copies} host to device copies"
+            print(
+                f"{name:>9}: {allocs} {device} allocations{copies}, "
+                f"{step_time * 1e3:.1f}ms at batch_size={args.batch_size}"
+            )
+
+
+def bench_cell_loops(args):
+    """
+    Inference of the decoder with nn.GRU note loops (decode_notes) against gru_cell
+    loops, without early exit
+    """
+    import torch
+    from dl_modules import PianoTreeDecoder
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    torch.manual_seed(0)
+    dec = PianoTreeDecoder(device, early_exit=False).to(device)
+    z = torch.randn(args.batch_size, dec.z_size, device=device)
+
+    def sync():
+        if device == "cuda":
+            torch.cuda.synchronize()
+
+    outputs = {}
+    with torch.no_grad():
+        for cell_loops in [False, True]:
+            dec.cell_loops = cell_loops
+            name = "gru_cell" if cell_loops else "nn.GRU"
+            outputs[cell_loops] = dec(z, True, None, None, 0, 0)
+            step_time = timeit(
+                lambda: (dec(z, True, None, None, 0, 0), sync()), args.repeat
+            )
+            print(
+                f"{name:>8}: {step_time * 1e3:.1f}ms at batch_size={args.batch_size}"
+            )
+    for part, module_out, cell_out in zip(["pitch", "dur"], *outputs.values()):
+        print(
+            f"{part} logits max abs difference: "
+            f"{(module_out - cell_out).abs().max():.3e}"
+        )
+        assert (module_out.argmax(-1) == cell_out.argmax(-1)).all(), part
+        assert torch.allclose(module_out, cell_out, atol=1e-5), part
+
+
+def bench_teacher_forcing(args):
+    """
+    Training step time of free-running decoding against full teacher forcing, and
+    the logits of teacher_forced_decoder against the decoding steps (asserting
+    allclose)
+    """
+    import torch
+    from model import Diffpro
+    from params import params
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    torch.manual_seed(0)
+    model = Diffpro(params).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=params.learning_rate)
+    pnotree_x = random_pnotree(args.batch_size, seed=0).to(device)
+    pnotree_y = random_pnotree(args.batch_size, seed=1).to(device)
+
+    dec = model.pnotree_dec
+    z = torch.randn(args.batch_size, dec.z_size, device=device)
+    outputs = {}
+    with torch.no_grad():
+        embedded, lengths = dec.emb_x(pnotree_y)
+        for parallel in [False, True]:
+            dec.parallel_teacher_forcing = parallel
+            outputs[parallel] = dec(z, False, embedded, lengths, 1, 1)
+    for part, stepwise, parallel in zip(["pitch", "dur"], *outputs.values()):
+        print(
+            f"{part} logits max abs difference: "
+            f"{(stepwise - parallel).abs().max():.3e}"
+        )
+        assert torch.allclose(stepwise, parallel, atol=1e-5), part
+
+    def step(tfr):
+        optimizer.zero_grad()
+        loss = model.get_loss_dict(pnotree_x, pnotree_y, tfr, tfr)["loss"]
+        loss.backward()
+        optimizer.step()
+        if device == "cuda":
+            torch.cuda.synchronize()
+
+    for tfr in [0, 1]:
+        step_time = timeit(lambda: step(tfr), args.repeat)
+        print(
+            f"tfr1=tfr2={tfr}: {step_time * 1e3:.1f}ms per step "
+            f"at batch_size={args.batch_size}"
+        )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='run a benchmark')
+    subparsers = parser.add_subparsers(required=True)
+
+    sub = subparsers.add_parser("index_lookup", help=bench_index_lookup.__doc__)
+    sub.add_argument("--num_songs", type=int, nargs="+", default=[100, 1000, 10000])
+    sub.add_argument("--batch_size", type=int, default=128)
+    sub.add_argument("--repeat", type=int, default=20)
+    sub.set_defaults(func=bench_index_lookup)
+
+    sub = subparsers.add_parser("song_format", help=bench_song_format.__doc__)
+    sub.add_argument("--num_songs", type=int, default=1000)
+    sub.set_defaults(func=bench_song_format)
+
+    sub = subparsers.add_parser("sampler", help=bench_sampler.__doc__)
+    sub.add_argument("--batch_size", type=int, default=128)
+    sub.add_argument("--num_steps", type=int, default=50)
+    sub.set_defaults(func=bench_sampler)
+
+    sub = subparsers.add_parser("pianotree_repr", help=bench_pianotree_repr.__doc__)
+    sub.add_argument("--num_segs", type=int, default=400)
+    sub.set_defaults(func=bench_pianotree_repr)
+
+    sub = subparsers.add_parser("midi", help=bench_midi.__doc__)
+    sub.add_argument("--num_cases", type=int, default=60)
+    sub.add_argument("--max_segs", type=int, default=40)
+    sub.add_argument("--chunk_sizes", type=int, nargs="+", default=[1, 3, 7, 50])
+    sub.set_defaults(func=bench_midi)
+
+    sub = subparsers.add_parser("embedding", help=bench_embedding.__doc__)
+    sub.add_argument("--batch_size", type=int, default=128)
+    sub.add_argument("--repeat", type=int, default=20)
+    sub.set_defaults(func=bench_embedding)
+
+    sub = subparsers.add_parser("pack_free", help=bench_pack_free.__doc__)
+    sub.add_argument("--batch_size", type=int, default=128)
+    sub.add_argument("--repeat", type=int, default=10)
+    sub.set_defaults(func=bench_pack_free)
+
+    sub = subparsers.add_parser("note_decoding", help=bench_note_decoding.__doc__)
+    sub.add_argument("--model_dir", help="trained Diffpro, else the pretrained one")
+    sub.add_argument("--num_songs", type=int, default=20)
+    sub.set_defaults(func=bench_note_decoding)
+
+    sub = subparsers.add_parser("decoding_allocs", help=bench_decoding_allocs.__doc__)
+    sub.add_argument("--batch_size", type=int, default=128)
+    sub.add_argument("--repeat", type=int, default=3)
+    sub.set_defaults(func=bench_decoding_allocs)
+
+    sub = subparsers.add_parser("cell_loops", help=bench_cell_loops.__doc__)
+    sub.add_argument("--batch_size", type=int, default=128)
+    sub.add_argument("--repeat", type=int, default=3)
+    sub.set_defaults(func=bench_cell_loops)
+
+    sub = subparsers.add_parser("teacher_forcing", help=bench_teacher_forcing.__doc__)
+    sub.add_argument("--batch_size", type=int, default=128)
+    sub.add_argument("--repeat", type=int, default=3)
+    sub.set_defaults(func=bench_teacher_forcing)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,58 +1,137 @@
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset
 from dataset import PianoOrchDataset
-from utils import (pianotree_pitch_shift, estx_to_midi_file)
+from segment_store import PianoOrchSegmentDataset
+from segment_shards import PianoOrchStreamDataset
+from sampler import BucketBatchSampler
+from utils import (
+    pianotree_batch_pitch_shift, pianotree_pitch_bounds, estx_to_midi_file
+)
+from functools import partial
 import numpy as np
 from params import params
 
 
-def collate_fn(batch):
-    def sample_shift():
-        return np.random.choice(np.arange(-6, 6), 1)[0]
+def clamp_pitch_shifts(pnotree_x, pnotree_y, shifts):
+    """Clamp shifts (B,) so that every shifted pitch of x and y is within [0, 127]"""
+    lowest_x, highest_x = pianotree_pitch_bounds(pnotree_x)
+    lowest_y, highest_y = pianotree_pitch_bounds(pnotree_y)
+    min_shift = -torch.minimum(lowest_x, lowest_y)
+    max_shift = 127 - torch.maximum(highest_x, highest_y)
+    return torch.maximum(torch.minimum(shifts, max_shift), min_shift)
 
-    pnotree_x = []
-    pnotree_y = []
-    song_fn = []
-    for b in batch:
-        # b[0]: seg_pnotree_x; b[1]: seg_pnotree_y
-        seg_pnotree_x = b[0]
-        seg_pnotree_y = b[1]
 
-        shift = sample_shift()
-        seg_pnotree_x = pianotree_pitch_shift(seg_pnotree_x, shift)
-        seg_pnotree_y = pianotree_pitch_shift(seg_pnotree_y, shift)
+def sample_pitch_shifts(pnotree_x, pnotree_y, low=-6, high=6):
+    """Sample one shift in [low, high) for each pair of a batch, clamped"""
+    batch_size = pnotree_x.size(0)
+    shifts = torch.randint(low, high, (batch_size,), device=pnotree_x.device)
+    return clamp_pitch_shifts(pnotree_x, pnotree_y, shifts)
 
-        pnotree_x.append(b[0])
-        pnotree_y.append(b[1])
 
-        if len(b) > 2:
-            song_fn.append(b[2])
+def pitch_shift_augment(pnotree_x, pnotree_y):
+    """
+    Transpose a batch of (pnotree_x, pnotree_y) pairs by random per-sample shifts,
+    in one vectorized op on the batch's device.
+    """
+    shifts = sample_pitch_shifts(pnotree_x, pnotree_y)
+    pnotree_x = pianotree_batch_pitch_shift(pnotree_x, shifts)
+    pnotree_y = pianotree_batch_pitch_shift(pnotree_y, shifts)
+    return pnotree_x, pnotree_y, shifts
 
-    pnotree_x = torch.Tensor(np.array(pnotree_x)).long()
-    pnotree_y = torch.Tensor(np.array(pnotree_y)).long()
+
+class IndexedDataset(Dataset):
+    """Items of `dataset` followed by their index"""
+    def __init__(self, dataset):
+        super(IndexedDataset, self).__init__()
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return (*self.dataset[index], index)
+
+    def __getitems__(self, indices):
+        items = self.dataset.__getitems__(indices)
+        return [(*item, index) for item, index in zip(items, indices)]
+
+    def seg_stats(self):
+        return self.dataset.seg_stats()
+
+
+def collate_fn(batch, pitch_shift=False, with_index=False):
+    # b[0]: seg_pnotree_x; b[1]: seg_pnotree_y; b[2] (debug): song_fn;
+    # b[-1] (with_index): index
+    pnotree_x = torch.from_numpy(np.stack([b[0] for b in batch])).long()
+    pnotree_y = torch.from_numpy(np.stack([b[1] for b in batch])).long()
+    song_fn = [b[2] for b in batch if len(b) > 2 + with_index]
+
+    if pitch_shift:
+        pnotree_x, pnotree_y, _ = pitch_shift_augment(pnotree_x, pnotree_y)
+
+    batch_out = (pnotree_x, pnotree_y)
     if len(song_fn) > 0:
-        return pnotree_x, pnotree_y, song_fn
-    else:
-        return pnotree_x, pnotree_y
+        batch_out += (song_fn, )
+    if with_index:
+        batch_out += (torch.tensor([b[-1] for b in batch], dtype=torch.long), )
+    return batch_out
 
 
 def get_train_val_dataloaders(batch_size, params, debug=False):
-    train_dataset, val_dataset = PianoOrchDataset.load_train_and_valid_sets(debug)
+    if params.data_backend == "compiled":
+        train_dataset, val_dataset = PianoOrchSegmentDataset.load_train_and_valid_sets(
+            debug
+        )
+    elif params.data_backend == "stream":
+        train_dataset, val_dataset = PianoOrchStreamDataset.load_train_and_valid_sets(
+            debug, params.num_workers
+        )
+    else:
+        train_dataset, val_dataset = PianoOrchDataset.load_train_and_valid_sets(
+            debug, params.lazy_songs, params.song_cache_bytes, params.shared_cache
+        )
+    with_index = params.latent_cache or params.summary_cache
+    if with_index:
+        # segment indices to look up cached features, which must see the shifts
+        assert params.data_backend != "stream", "streamed segments have no index"
+        assert params.pitch_shift_aug != "worker"
+        train_dataset = IndexedDataset(train_dataset)
+        val_dataset = IndexedDataset(val_dataset)
+
+    # training pairs are transposed in the workers, or later on the training device
+    train_collate_fn = partial(
+        collate_fn,
+        pitch_shift=params.pitch_shift_aug == "worker",
+        with_index=with_index
+    )
+    val_collate_fn = partial(collate_fn, with_index=with_index)
+    if params.data_backend == "stream":
+        # shuffled by the dataset itself
+        train_dl_kwargs = {"batch_size": batch_size}
+    elif params.bucket_sampler:
+        # batches of segments with similar polyphony, shuffled by bucket
+        batch_sampler = BucketBatchSampler(
+            train_dataset.seg_stats(), batch_size, params.num_buckets
+        )
+        train_dl_kwargs = {"batch_sampler": batch_sampler}
+    else:
+        train_dl_kwargs = {"batch_size": batch_size, "shuffle": True}
     train_dl = DataLoader(
         train_dataset,
-        batch_size,
-        True,
-        collate_fn=collate_fn,
+        **train_dl_kwargs,
+        collate_fn=train_collate_fn,
         num_workers=params.num_workers,
-        pin_memory=params.pin_memory
+        pin_memory=params.pin_memory,
+        persistent_workers=params.num_workers > 0
     )
     val_dl = DataLoader(
         val_dataset,
         batch_size,
-        True,
-        collate_fn=collate_fn,
+        params.data_backend != "stream",
+        collate_fn=val_collate_fn,
         num_workers=params.num_workers,
-        pin_memory=params.pin_memory
+        pin_memory=params.pin_memory,
+        persistent_workers=params.num_workers > 0
     )
     return train_dl, val_dl
 
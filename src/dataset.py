@@ -1,9 +1,17 @@
 # pyright: reportOptionalSubscript=false
 
 from torch.utils.data import Dataset
-from utils import (nmat_to_pianotree_repr, nmat_to_pr_mat_repr, estx_to_midi_file)
-from utils import read_dict
+from utils import (
+    nmat_to_pianotree_repr, nmats_to_pianotree_repr, nmat_to_pr_mat_repr,
+    estx_to_midi_file
+)
+from utils import read_dict, save_dict
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+from shared_cache import SharedSegmentCache
 from dirs import *
+import hashlib
 import os
 import torch
 import numpy as np
@@ -12,6 +20,24 @@ SEG_LGTH = 8
 N_BIN = 4
 SEG_LGTH_BIN = SEG_LGTH * N_BIN
 
+# rough resident size of one python dict entry (slot, int key and value objects)
+DICT_ENTRY_BYTES = 100
+
+# per-song lengths, statistics and consistency flags, see `read_corpus_index`
+CORPUS_INDEX_FN = "corpus_index.pickle"
+
+# pickle-free song file, see `convert_song_to_compact`
+COMPACT_FN = "song.npz"
+NOTE_DTYPE = np.dtype(
+    [
+        ("onset", np.int32),
+        ("pitch", np.uint8),
+        ("duration", np.int16),
+        ("velocity", np.uint8),
+        ("program", np.uint8),
+    ]
+)
+
 
 class DataSampleNpz:
     """
@@ -55,18 +81,7 @@ class DataSampleNpz:
         # def load(self, use_chord=False):
         #     """ load data """
 
-        # TODO: multiple piano & orchestra versions
-        data_x = np.load(self.fpath_x, allow_pickle=True)
-        self.notes_x = data_x["notes"]
-        self.start_table_x = data_x["start_table"].item()
-
-        data_y = np.load(self.fpath_y, allow_pickle=True)
-        self.notes_y = data_y["notes"]
-        self.start_table_y = data_y["start_table"].item()
-
-        # self.db_pos = data_x["db_pos"]
-        self.db_pos_filter = data_x["db_pos_filter"]
-        self.db_pos = data_x["db_pos"][self.db_pos_filter]
+        self._load()
 
         self._nmat_dict_x = dict(zip(self.db_pos, [None] * len(self.db_pos)))
         self._pnotree_dict_x = dict(zip(self.db_pos, [None] * len(self.db_pos)))
@@ -84,10 +99,52 @@ class DataSampleNpz:
         if len(self.db_pos) != 0:
             self.last_db = self.db_pos[-1]
 
+        # bytes of the segments stored in the per-downbeat dicts so far
+        self._seg_nbytes = 0
+
+    def _load(self):
+        """Load notes, start_table and db_pos of x and y"""
+        # TODO: multiple piano & orchestra versions
+        data_x = np.load(self.fpath_x, allow_pickle=True)
+        self.notes_x = data_x["notes"]
+        self.start_table_x = data_x["start_table"].item()
+
+        data_y = np.load(self.fpath_y, allow_pickle=True)
+        self.notes_y = data_y["notes"]
+        self.start_table_y = data_y["start_table"].item()
+
+        # self.db_pos = data_x["db_pos"]
+        self.db_pos_filter = data_x["db_pos_filter"]
+        self.db_pos = data_x["db_pos"][self.db_pos_filter]
+
     def __len__(self):
         """Return number of complete 8-beat segments in a song"""
         return len(self.db_pos)
 
+    def nbytes(self):
+        """Approximate resident memory of this song, including stored segments"""
+        nbytes = (
+            self.notes_x.nbytes + self.notes_y.nbytes + self.db_pos.nbytes +
+            self.db_pos_filter.nbytes + 8 * len(self.db_pos) * DICT_ENTRY_BYTES
+        )
+        for start_table in (self.start_table_x, self.start_table_y):
+            if isinstance(start_table, dict):
+                nbytes += len(start_table) * DICT_ENTRY_BYTES
+            else:
+                nbytes += start_table.nbytes
+        return nbytes + self._seg_nbytes
+
+    @staticmethod
+    def read_num_segments(song_fn):
+        """
+        Number of segments of a song without loading its notes and start_table
+        """
+        fpath = os.path.join(DATA_DIR, song_fn, COMPACT_FN)
+        if not os.path.exists(fpath):
+            fpath = os.path.join(DATA_DIR, song_fn, "orchestra.npz")
+        data_x = np.load(fpath)
+        return len(data_x["db_pos"][data_x["db_pos_filter"]])
+
     def note_mat_seg_at_db_x(self, db):
         """
         Select rows (notes) of the note_mat which lie between beats
@@ -150,6 +207,7 @@ class DataSampleNpz:
 
         nmat = self.format_reset_seg_mat(nmat)
         self._nmat_dict_x[db] = nmat
+        self._seg_nbytes += nmat.nbytes
 
     def store_nmat_seg_y(self, db):
         """
@@ -163,6 +221,7 @@ class DataSampleNpz:
 
         nmat = self.format_reset_seg_mat(nmat)
         self._nmat_dict_y[db] = nmat
+        self._seg_nbytes += nmat.nbytes
 
     def store_pnotree_seg_x(self, db):
         """
@@ -172,6 +231,7 @@ class DataSampleNpz:
             return
 
         self._pnotree_dict_x[db] = nmat_to_pianotree_repr(self._nmat_dict_x[db])
+        self._seg_nbytes += self._pnotree_dict_x[db].nbytes
 
     def store_pnotree_seg_y(self, db):
         """
@@ -181,6 +241,7 @@ class DataSampleNpz:
             return
 
         self._pnotree_dict_y[db] = nmat_to_pianotree_repr(self._nmat_dict_y[db])
+        self._seg_nbytes += self._pnotree_dict_y[db].nbytes
 
     def _store_seg(self, db):
         self.store_nmat_seg_x(db)
@@ -204,63 +265,441 @@ class DataSampleNpz:
         db = self.db_pos[idx]
         return self._get_item_by_db(db)
 
-    def get_whole_song_data(self):
+    def get_all_segs(self):
         """
-        used when inference
+        Return pianotree_x, pianotree_y of all segments, (len(self), 32, 20, 6) each.
+        Used when compiling, no per-segment caches are filled.
         """
-        pnotree_x = []
-        pnotree_y = []
+        nmats_x = []
+        nmats_y = []
+        for db in self.db_pos:
+            nmat_x = self.note_mat_seg_at_db_x(db)
+            self.reset_db_to_zeros(nmat_x, db)
+            nmats_x.append(self.format_reset_seg_mat(nmat_x))
+            nmat_y = self.note_mat_seg_at_db_y(db)
+            self.reset_db_to_zeros(nmat_y, db)
+            nmats_y.append(self.format_reset_seg_mat(nmat_y))
+        return nmats_to_pianotree_repr(nmats_x), nmats_to_pianotree_repr(nmats_y)
+
+    def get_seg_stats(self):
+        """
+        Return (len(self), 4) segment statistics, the columns are
+            note_count_x, max_polyphony_x, note_count_y, max_polyphony_y
+        where max_polyphony is the largest number of notes starting at one step.
+        """
+        stats = np.zeros((len(self), 4), dtype=np.int64)
+        for i, db in enumerate(self.db_pos):
+            nmats = (self.note_mat_seg_at_db_x(db), self.note_mat_seg_at_db_y(db))
+            for j, nmat in enumerate(nmats):
+                if len(nmat) == 0:
+                    continue
+                stats[i, 2 * j] = len(nmat)
+                stats[i, 2 * j + 1] = np.bincount(nmat[:, 0] - db).max()
+        return stats
+
+    def whole_song_dbs(self):
+        """The downbeats of the consecutive segments that cover the whole song"""
+        dbs = []
         idx = 0
         i = 0
         while i < len(self):
-            seg_pnotree_x, seg_pnotree_y = self[i]
-            pnotree_x.append(seg_pnotree_x)
-            pnotree_y.append(seg_pnotree_y)
+            dbs.append(self.db_pos[i])
 
             idx += SEG_LGTH_BIN
             while i < len(self) and self.db_pos[i] < idx:
                 i += 1
+        return dbs
+
+    def get_whole_song_data(self):
+        """
+        used when inference
+        """
+        pnotree_x = []
+        pnotree_y = []
+        for db in self.whole_song_dbs():
+            seg_pnotree_x, seg_pnotree_y = self._get_item_by_db(db)
+            pnotree_x.append(seg_pnotree_x)
+            pnotree_y.append(seg_pnotree_y)
         pnotree_x = torch.from_numpy(np.array(pnotree_x, dtype=np.int64))
         pnotree_y = torch.from_numpy(np.array(pnotree_y, dtype=np.int64))
         return pnotree_x, pnotree_y
 
+    def iter_whole_song_x(self, chunk_size):
+        """
+        pianotree_x of `get_whole_song_data` in chunks of (at most) chunk_size
+        segments, (chunk_size, 32, 20, 6) int64 tensors. Chunks are converted when
+        requested and not stored, so memory is bounded by chunk_size, not the song.
+        """
+        dbs = self.whole_song_dbs()
+        for start in range(0, len(dbs), chunk_size):
+            nmats_x = []
+            for db in dbs[start : start + chunk_size]:
+                nmat_x = self.note_mat_seg_at_db_x(db)
+                self.reset_db_to_zeros(nmat_x, db)
+                nmats_x.append(self.format_reset_seg_mat(nmat_x))
+            yield torch.from_numpy(nmats_to_pianotree_repr(nmats_x))
+
+
+class DataSampleCompact(DataSampleNpz):
+    """
+    DataSampleNpz read from the compact format (`COMPACT_FN`), no unpickling.
+        notes_x/y: (N,), NOTE_DTYPE
+        start_table_x/y: dense int32 array indexed by beat bin
+    """
+    def __init__(self, song_fn) -> None:
+        self.fpath = os.path.join(DATA_DIR, song_fn, COMPACT_FN)
+        super(DataSampleCompact, self).__init__(song_fn)
+
+    def _load(self):
+        data = np.load(self.fpath)
+        self.notes_x = data["notes_x"]
+        self.start_table_x = data["start_table_x"]
+        self.notes_y = data["notes_y"]
+        self.start_table_y = data["start_table_y"]
+        self.db_pos_filter = data["db_pos_filter"]
+        self.db_pos = data["db_pos"][self.db_pos_filter]
+
+    @staticmethod
+    def _to_nmat(notes):
+        """(N,) NOTE_DTYPE notes to a (N, 3) note matrix of onset, pitch, duration"""
+        nmat = np.empty((len(notes), 3), dtype=np.int64)
+        nmat[:, 0] = notes["onset"]
+        nmat[:, 1] = notes["pitch"]
+        nmat[:, 2] = notes["duration"]
+        return nmat
+
+    @staticmethod
+    def _start_row(start_table, db):
+        """
+        start_table[db], raising KeyError for bins missing from the table (-1) as
+        the dict of DataSampleNpz does, rather than slicing from the end
+        """
+        row = start_table[db] if 0 <= db < len(start_table) else -1
+        if row < 0:
+            raise KeyError(int(db))
+        return row
+
+    def note_mat_seg_at_db_x(self, db):
+        e_db = db + SEG_LGTH_BIN if db + SEG_LGTH_BIN <= self.last_db else self.last_db
+        s_ind = self._start_row(self.start_table_x, db)
+        e_ind = self._start_row(self.start_table_x, e_db)
+        return self._to_nmat(self.notes_x[s_ind : e_ind])
+
+    def note_mat_seg_at_db_y(self, db):
+        e_db = db + SEG_LGTH_BIN if db + SEG_LGTH_BIN <= self.last_db else self.last_db
+        s_ind = self._start_row(self.start_table_y, db)
+        e_ind = self._start_row(self.start_table_y, e_db)
+        return self._to_nmat(self.notes_y[s_ind : e_ind])
+
+
+def _compact_notes(notes):
+    compact = np.empty(len(notes), dtype=NOTE_DTYPE)
+    for i, name in enumerate(NOTE_DTYPE.names):
+        compact[name] = notes[:, i]
+    return compact
+
+
+def _dense_start_table(start_table):
+    """start_table dict (beat bin -> row) to an int32 array, -1 for missing bins"""
+    dense = np.full(max(start_table.keys()) + 1, -1, dtype=np.int32)
+    dense[list(start_table.keys())] = list(start_table.values())
+    return dense
+
+
+def convert_song_to_compact(song_fn):
+    """Write orchestra.npz and piano.npz of a song into a single `COMPACT_FN`"""
+    dpath = os.path.join(DATA_DIR, song_fn)
+    data_x = np.load(os.path.join(dpath, "orchestra.npz"), allow_pickle=True)
+    data_y = np.load(os.path.join(dpath, "piano.npz"), allow_pickle=True)
+    np.savez(
+        os.path.join(dpath, COMPACT_FN),
+        notes_x=_compact_notes(data_x["notes"]),
+        start_table_x=_dense_start_table(data_x["start_table"].item()),
+        notes_y=_compact_notes(data_y["notes"]),
+        start_table_y=_dense_start_table(data_y["start_table"].item()),
+        db_pos=data_x["db_pos"].astype(np.int32),
+        db_pos_filter=data_x["db_pos_filter"],
+    )
+
+
+def open_data_sample(song_fn):
+    """The compact format of a song if it has been converted, else its npz files"""
+    if os.path.exists(os.path.join(DATA_DIR, song_fn, COMPACT_FN)):
+        return DataSampleCompact(song_fn)
+    return DataSampleNpz(song_fn)
+
+
+def _song_mtime(song_fn):
+    dpath = os.path.join(DATA_DIR, song_fn)
+    return max(entry.stat().st_mtime for entry in os.scandir(dpath))
+
+
+def scan_song(song_fn):
+    """
+    Return the corpus index entry of a song:
+        mtime: latest modification time of the song files
+        num_segs: number of segments
+        seg_stats: (num_segs, 4), see `DataSampleNpz.get_seg_stats`
+        start_table_match: x and y start_tables have the same length
+        db_in_start_table: every segment boundary is in both start_tables
+        error: the error raised while reading segments, or None
+    """
+    song = open_data_sample(song_fn)
+    lgth_x, lgth_y = len(song.start_table_x), len(song.start_table_y)
+    entry = {
+        "mtime": _song_mtime(song_fn),
+        "num_segs": len(song),
+        "seg_stats": np.zeros((len(song), 4), dtype=np.int64),
+        "start_table_match": lgth_x == lgth_y,
+        "db_in_start_table": bool(len(song) == 0 or song.last_db < min(lgth_x, lgth_y)),
+        "error": None,
+    }
+    try:
+        entry["seg_stats"] = song.get_seg_stats()
+    except Exception as e:
+        entry["error"] = repr(e)
+    return entry
+
+
+def read_corpus_index(song_fns=None, num_workers=None, check_mtime=False):
+    """
+    Read the corpus index (CORPUS_INDEX_FN under TRAIN_SPLIT_DIR), a dict of
+    song_fn -> `scan_song(song_fn)`, updating it incrementally.
+    Songs of `song_fns` (by default, every song under DATA_DIR) missing from the
+    index are scanned in a process pool, and so are songs modified since their
+    scan if `check_mtime`. Songs no longer under DATA_DIR are dropped.
+    """
+    index_fpath = os.path.join(TRAIN_SPLIT_DIR, CORPUS_INDEX_FN)
+    index = read_dict(index_fpath) if os.path.exists(index_fpath) else {}
+    if song_fns is None:
+        song_fns = sorted(os.listdir(DATA_DIR))
+        present = set(song_fns)
+        removed = [song_fn for song_fn in index if song_fn not in present]
+    else:
+        removed = []
+
+    stale = [
+        song_fn for song_fn in song_fns if song_fn not in index or
+        (check_mtime and _song_mtime(song_fn) > index[song_fn]["mtime"])
+    ]
+    if len(stale) == 0 and len(removed) == 0:
+        return index
+
+    for song_fn in removed:
+        del index[song_fn]
+    with ProcessPoolExecutor(num_workers) as pool:
+        entries = pool.map(scan_song, stale, chunksize=16)
+        for song_fn, entry in tqdm(zip(stale, entries), "Scanning", len(stale)):
+            index[song_fn] = entry
+    for song_fn in stale:
+        entry = index[song_fn]
+        if not (entry["start_table_match"] and entry["db_in_start_table"]):
+            print(f"inconsistent start_table: {song_fn}")
+        if entry["error"] is not None:
+            print(f"{song_fn}: {entry['error']}")
+    save_dict(index_fpath, index)
+    return index
+
+
+def _read_valid_entries(song_fns):
+    """
+    The corpus index, raising the recorded error of the first song of song_fns
+    whose segments could not be read
+    """
+    index = read_corpus_index(song_fns)
+    for song_fn in song_fns:
+        if index[song_fn]["error"] is not None:
+            raise RuntimeError(f"{song_fn}: {index[song_fn]['error']}")
+    return index
+
+
+def read_song_lengths(song_fns):
+    """Number of segments of each song, from the corpus index"""
+    index = _read_valid_entries(song_fns)
+    return np.array([index[song_fn]["num_segs"] for song_fn in song_fns],
+                    dtype=np.int64)
+
+
+def read_seg_stats(song_fns):
+    """Statistics of every segment of the songs, from the corpus index"""
+    index = _read_valid_entries(song_fns)
+    stats = [index[song_fn]["seg_stats"] for song_fn in song_fns]
+    return np.concatenate([np.zeros((0, 4), dtype=np.int64)] + stats)
+
+
+class LazyDataSamples:
+    """
+    A list of DataSampleNpz which opens a song on its first access.
+    Songs are kept in an LRU: when the resident songs exceed `max_bytes`, the least
+    recently used ones are evicted as a whole. Each DataLoader worker holds its own
+    LRU, so the budget applies per worker.
+    """
+    def __init__(self, song_fns, lgths, max_bytes):
+        self.song_fns = song_fns
+        self.lgths = lgths
+        self.max_bytes = max_bytes
+
+        self._songs = OrderedDict()  # song_no -> DataSampleNpz, oldest first
+        self._song_nbytes = {}  # song_no -> nbytes at its last access
+        self._nbytes = 0
+        self._last_song_no = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.song_fns)
+
+    def _update_nbytes(self, song_no):
+        nbytes = self._songs[song_no].nbytes()
+        self._nbytes += nbytes - self._song_nbytes.get(song_no, 0)
+        self._song_nbytes[song_no] = nbytes
+
+    def _evict(self):
+        # the song just accessed is never evicted
+        while self._nbytes > self.max_bytes and len(self._songs) > 1:
+            song_no, _ = self._songs.popitem(last=False)
+            self._nbytes -= self._song_nbytes.pop(song_no)
+            self.evictions += 1
+
+    def __getitem__(self, song_no):
+        # segments are stored into the song after it is returned,
+        # so the previous song may have grown since
+        if self._last_song_no in self._songs:
+            self._update_nbytes(self._last_song_no)
+
+        if song_no in self._songs:
+            self.hits += 1
+            self._songs.move_to_end(song_no)
+        else:
+            self.misses += 1
+            self._songs[song_no] = open_data_sample(self.song_fns[song_no])
+            self._update_nbytes(song_no)
+        self._last_song_no = song_no
+        self._evict()
+        return self._songs[song_no]
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "resident_songs": len(self._songs),
+            "resident_bytes": self._nbytes,
+        }
+
 
 class PianoOrchDataset(Dataset):
-    def __init__(self, data_samples, debug=False):
+    def __init__(self, data_samples, debug=False, shared_cache=False):
         super(PianoOrchDataset, self).__init__()
 
-        # a list of DataSampleNpz
+        # a list of DataSampleNpz, or LazyDataSamples
         self.data_samples = data_samples
 
-        self.lgths = np.array([len(d) for d in self.data_samples], dtype=np.int64)
+        if isinstance(data_samples, LazyDataSamples):
+            self.lgths = data_samples.lgths
+        else:
+            self.lgths = np.array([len(d) for d in data_samples], dtype=np.int64)
         self.lgth_cumsum = np.cumsum(self.lgths)
+        # segments of the i-th song are [song_offsets[i]: song_offsets[i + 1]]
+        self.song_offsets = np.insert(self.lgth_cumsum, 0, 0)
         self.debug = debug
 
+        # segments converted by any worker, shared by all of them
+        self.shared_cache = None
+        if shared_cache:
+            self.shared_cache = SharedSegmentCache.create(len(self))
+
     def __len__(self):
         return self.lgth_cumsum[-1]
 
-    def __getitem__(self, index):
-        # song_no is the smallest id that > dataset_item
-        song_no = np.where(self.lgth_cumsum > index)[0][0]
-        song_item = index - np.insert(self.lgth_cumsum, 0, 0)[song_no]
+    def locate(self, index):
+        """
+        Map global (array of) indices to (song_no, song_item).
+        song_no is the smallest id whose cumulative length > index.
+        """
+        song_no = np.searchsorted(self.lgth_cumsum, index, side="right")
+        song_item = index - self.song_offsets[song_no]
+        return song_no, song_item
+
+    def _get_song_fn(self, song_no):
+        if isinstance(self.data_samples, LazyDataSamples):
+            return self.data_samples.song_fns[song_no]
+        return self.data_samples[song_no].song_fn
+
+    def _get_song_item(self, index, song_no, song_item):
+        seg = None
+        if self.shared_cache is not None:
+            seg = self.shared_cache.get(index)
+        if seg is None:
+            seg = self.data_samples[song_no][song_item]
+            if self.shared_cache is not None:
+                self.shared_cache.put(index, *seg)
 
-        song_data = self.data_samples[song_no]
         if self.debug:
-            return *song_data[song_item], song_data.song_fn
+            return *seg, self._get_song_fn(song_no)
+        else:
+            return seg
+
+    def __getitem__(self, index):
+        song_no, song_item = self.locate(index)
+        return self._get_song_item(index, song_no, song_item)
+
+    def __getitems__(self, indices):
+        """Fetch a whole sampler batch, used by DataLoader"""
+        indices = np.asarray(indices, dtype=np.int64)
+        song_nos, song_items = self.locate(indices)
+        return [
+            self._get_song_item(index, song_no, song_item)
+            for index, song_no, song_item in zip(indices, song_nos, song_items)
+        ]
+
+    def seg_stats(self):
+        """(len(self), 4) statistics of every segment, see `read_seg_stats`"""
+        if isinstance(self.data_samples, LazyDataSamples):
+            song_fns = self.data_samples.song_fns
         else:
-            return song_data[song_item]
+            song_fns = [song.song_fn for song in self.data_samples]
+        return read_seg_stats(song_fns)
+
+    def fingerprint(self):
+        """sha1 of the ordered songs, their segment counts and modification times"""
+        sha1 = hashlib.sha1()
+        for song_no, lgth in enumerate(self.lgths):
+            song_fn = self._get_song_fn(song_no)
+            sha1.update(f"{song_fn}\0{lgth}\0{_song_mtime(song_fn)}\n".encode())
+        return sha1.hexdigest()
+
+    def cache_stats(self):
+        """Counters of the song LRU (lazy datasets) and the shared segment cache"""
+        stats = {}
+        if isinstance(self.data_samples, LazyDataSamples):
+            stats["songs"] = self.data_samples.stats()
+        if self.shared_cache is not None:
+            stats["segments"] = self.shared_cache.stats()
+        return stats
 
     @classmethod
-    def load_with_song_paths(cls, song_paths, debug):
-        data_samples = [DataSampleNpz(song_path) for song_path in song_paths]
-        return cls(data_samples, debug)
+    def load_with_song_paths(
+        cls, song_paths, debug, lazy=False, max_bytes=None, shared_cache=False
+    ):
+        if lazy:
+            data_samples = LazyDataSamples(
+                song_paths, read_song_lengths(song_paths), max_bytes
+            )
+        else:
+            data_samples = [open_data_sample(song_path) for song_path in song_paths]
+        return cls(data_samples, debug, shared_cache)
 
     @classmethod
-    def load_train_and_valid_sets(cls, debug=False):
+    def load_train_and_valid_sets(
+        cls, debug=False, lazy=False, max_bytes=None, shared_cache=False
+    ):
         split = read_dict(os.path.join(TRAIN_SPLIT_DIR, "split_dict.pickle"))
-        return cls.load_with_song_paths(split[0], debug), cls.load_with_song_paths(
-            split[1], debug
-        )
+        return cls.load_with_song_paths(
+            split[0], debug, lazy, max_bytes, shared_cache
+        ), cls.load_with_song_paths(split[1], debug, lazy, max_bytes, shared_cache)
 
 
 if __name__ == "__main__":
@@ -3,6 +3,12 @@ import os
 # dataset paths
 DATA_DIR = "data/LOP_4_bin_pnt"
 TRAIN_SPLIT_DIR = "data/train_split_pnt"
+# precompiled pianotree segments of each split (see segment_store.py)
+COMPILED_DIR = "data/compiled_pnt"
+# shards of the compiled segments for streaming (see segment_shards.py)
+SHARD_DIR = "data/shards_pnt"
+# features of the frozen pretrained modules (see feature_cache.py)
+FEATURE_CACHE_DIR = "data/feature_cache"
 
 # pretrained path
 PT_PNOTREE_PATH = "pretrained/pnotree_20/train_20-last-model.pt"
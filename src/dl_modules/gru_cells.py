@@ -0,0 +1,17 @@
+import torch
+import torch.nn.functional as F
+
+
+def gru_cell(gi, h, weight_hh, bias_hh):
+    """
+    One step of a GRU from its input projection gi = W_ih x + b_ih, which callers
+    can precompute or look up, with the gate layout of nn.GRU (r, z, n).
+    """
+    # gi: (N, 3 * hidden_size), h: (N, hidden_size)
+    gh = F.linear(h, weight_hh, bias_hh)
+    i_r, i_z, i_n = gi.chunk(3, dim=-1)
+    h_r, h_z, h_n = gh.chunk(3, dim=-1)
+    r = torch.sigmoid(i_r + h_r)
+    z = torch.sigmoid(i_z + h_z)
+    n = torch.tanh(i_n + r * h_n)
+    return n + z * (h - n)
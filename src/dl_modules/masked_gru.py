@@ -0,0 +1,41 @@
+import torch
+
+
+def reverse_padded(x, lengths):
+    """Reverse each sequence of the padded batch x (N, T, ...) within its length."""
+    steps = torch.arange(x.size(1), device=x.device)
+    lengths = lengths.view(-1, 1)
+    inds = torch.where(steps < lengths, lengths - 1 - steps, steps)
+    inds = inds.view(*inds.shape, *([1] * (x.dim() - 2))).expand_as(x)
+    return x.gather(1, inds)
+
+
+def masked_gru_final_states(gru, x, lengths):
+    """
+    The final states h_n of a one-layer, batch_first gru over the padded batch
+    x (N, T, input_size), equal to running it on
+    pack_padded_sequence(x, lengths, enforce_sorted=False). The whole padded batch
+    runs through the gru and each state is gathered at its length, so lengths can
+    stay on x's device and nothing is sorted or copied to the host.
+    Returns h_n: (num_directions, N, hidden_size)
+    """
+    assert gru.num_layers == 1 and gru.batch_first
+    hid_size = gru.hidden_size
+    lengths = lengths.view(-1).to(x.device)
+    last = (lengths - 1).clamp(min=0).view(-1, 1, 1).expand(-1, 1, hid_size)
+    hx = x.new_zeros(1, x.size(0), hid_size)
+    suffixes = ["", "_reverse"] if gru.bidirectional else [""]
+    h_n = []
+    for suffix in suffixes:
+        # the backward direction is the forward recurrence over the reversed
+        # sequences, which also ends at length - 1
+        inputs = x if suffix == "" else reverse_padded(x, lengths)
+        names = ["weight_ih", "weight_hh"]
+        if gru.bias:
+            names += ["bias_ih", "bias_hh"]
+        weights = [getattr(gru, f"{name}_l0{suffix}") for name in names]
+        outputs, _ = torch.gru(
+            inputs, hx, weights, gru.bias, 1, 0.0, gru.training, False, True
+        )
+        h_n.append(outputs.gather(1, last).squeeze(1))
+    return torch.stack(h_n)
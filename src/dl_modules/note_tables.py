@@ -0,0 +1,42 @@
+import torch
+import torch.nn.functional as F
+
+
+def note_embedding_table(note_embedding, pitch_range, dur_width):
+    """
+    note_embedding (nn.Linear of multi-hot notes: pitch_range pitch columns, then
+    dur_width duration bits) as a small table: a row per pitch (the pitch column of
+    the weight, zero for pitch_pad) and a row per duration (the projection, with
+    bias, of its dur_width digits in {0, 1, dur_pad}, read in base 3).
+    Returns the table and the base-3 place values of the duration digits.
+    """
+    weight = note_embedding.weight
+    device = weight.device
+    # pitch_pad is dropped by the multi-hot tensor, i.e. a zero row
+    pitch_table = F.pad(weight[:, 0 : pitch_range].t(), (0, 0, 0, 1))
+    powers = 3**torch.arange(dur_width - 1, -1, -1, device=device)
+    durs = torch.arange(3**dur_width, device=device).unsqueeze(-1)
+    durs = (durs // powers % 3).float()
+    dur_table = F.linear(durs, weight[:, pitch_range :], note_embedding.bias)
+    return torch.cat([pitch_table, dur_table]), powers
+
+
+def note_table_inds(pitch_inds, dur_inds, powers, pitch_range):
+    """
+    The (pitch, duration) rows in `note_embedding_table` of the notes with
+    pitch_inds (...) and dur_inds (..., dur_width), as (num_notes, 2)
+    """
+    dur_inds = (dur_inds * powers).sum(-1) + pitch_range + 1
+    return torch.stack([pitch_inds, dur_inds], dim=-1).view(-1, 2)
+
+
+def embed_note_inds(pitch_inds, dur_inds, table, powers, pitch_range):
+    """
+    note_embedding of the multi-hot notes with pitch_inds (...) and dur_inds
+    (..., dur_width), looked up in `note_embedding_table`. Each note sums the row
+    of its pitch and the row of its duration.
+    """
+    embedded = F.embedding_bag(
+        note_table_inds(pitch_inds, dur_inds, powers, pitch_range), table, mode="sum"
+    )
+    return embedded.view(*pitch_inds.shape, -1)
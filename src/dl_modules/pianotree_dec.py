@@ -1,9 +1,13 @@
 from torch import nn
 import torch
+import torch.nn.functional as F
 import random
 from torch.nn.utils.rnn import pack_padded_sequence
 import pretty_midi
 import numpy as np
+from .masked_gru import masked_gru_final_states
+from .gru_cells import gru_cell
+from .note_tables import embed_note_inds, note_embedding_table, note_table_inds
 
 
 class PianoTreeDecoder(nn.Module):
@@ -27,6 +31,10 @@ class PianoTreeDecoder(nn.Module):
         dec_notes_hid_size=512,
         dec_z_in_size=256,
         dec_dur_hid_size=16,
+        pack_free=False,
+        early_exit=False,
+        cell_loops=False,
+        parallel_teacher_forcing=True,
     ):
         super(PianoTreeDecoder, self).__init__()
         # Parameters
@@ -60,6 +68,15 @@ class PianoTreeDecoder(nn.Module):
         self.dec_notes_hid_size = dec_notes_hid_size
         self.dur_sos_token = nn.Parameter(torch.rand(self.dur_width))
         self.dec_dur_hid_size = dec_dur_hid_size
+        # run dec_notes_emb_gru on the padded notes, see masked_gru_final_states
+        self.pack_free = pack_free
+        # at inference, decode the notes of each step with infer_notes, which
+        # changes the outputs after each row's first eos
+        self.early_exit = early_exit
+        # at inference, run the note loops with gru_cell, see infer_notes_cells
+        self.cell_loops = cell_loops
+        # with full teacher forcing, run teacher_forced_decoder instead of the steps
+        self.parallel_teacher_forcing = parallel_teacher_forcing
 
         # Modules
         # For both encoder and decoder
@@ -129,32 +146,92 @@ class PianoTreeDecoder(nn.Module):
             out = torch.cat([out[:, :, :, 0 : self.pitch_range], dur_part], dim=-1)
         return out
 
-    def get_sos_token(self):
-        sos = torch.zeros(self.note_size)
-        sos[self.pitch_sos] = 1.0
-        sos[self.pitch_range :] = 2.0
-        sos = sos.to(self.device)
-        return sos
-
-    def dur_ind_to_dur_token(self, inds, batch_size):
-        token = torch.zeros(batch_size, self.dur_width)
-        token[range(0, batch_size), inds] = 1.0
-        token = token.to(self.device)
-        return token
-
-    def pitch_dur_ind_to_note_token(self, pitch_inds, dur_inds, batch_size):
-        token = torch.zeros(batch_size, self.note_size)
-        token[range(0, batch_size), pitch_inds] = 1.0
-        token[:, self.pitch_range :] = dur_inds
-        token = token.to(self.device)
-        token = self.note_embedding(token)
-        return token
-
-    def decode_note(self, note_summary, batch_size):
+    def note_embedding_table(self):
+        """note_embedding as a small table, see note_tables.note_embedding_table"""
+        return note_embedding_table(
+            self.note_embedding, self.pitch_range, self.dur_width
+        )
+
+    def embed_note_inds(self, pitch_inds, dur_inds, table, powers):
+        """note_tables.embed_note_inds of this decoder's pitch_range"""
+        return embed_note_inds(pitch_inds, dur_inds, table, powers, self.pitch_range)
+
+    def note_table_inds(self, pitch_inds, dur_inds, powers):
+        """note_tables.note_table_inds of this decoder's pitch_range"""
+        return note_table_inds(pitch_inds, dur_inds, powers, self.pitch_range)
+
+    def embed_index_tensor(self, ind_x):
+        """
+        note_embedding(index_tensor_to_multihot_tensor(ind_x)) without the
+        multi-hot tensor, see embed_note_inds.
+        """
+        # ind_x: (B, 32, max_simu_note, 1 + dur_width)
+        table, powers = self.note_embedding_table()
+        return self.embed_note_inds(
+            ind_x[:, :, :, 0], ind_x[:, :, :, 1 :], table, powers
+        )
+
+    def decoding_buffers(self, batch_size, cells=False):
+        """
+        What the autoregressive decoding steps reuse, built once per call directly
+        on the device: the note embedding table, one-hot duration tokens, the sos
+        tokens of durations and notes, and the predicted notes before any step.
+        With cells, also the weights of infer_notes_cells, see cell_weights.
+        """
+        table, powers = self.note_embedding_table()
+        sos_pitch = torch.full((1,), self.pitch_sos, device=self.device)
+        sos_dur = torch.full((1, self.dur_width), self.dur_pad, device=self.device)
+        note_sos = self.embed_note_inds(sos_pitch, sos_dur, table, powers)
+        notes_init = torch.zeros(
+            batch_size, self.max_simu_note, self.note_emb_size, device=self.device
+        )
+        notes_init[:, :, self.pitch_range :] = 2.0
+        notes_init[:, 0] = note_sos
+        buffers = {
+            "note_table": table,
+            "dur_powers": powers,
+            "dur_tokens": torch.eye(self.dur_width, device=self.device),
+            "dur_sos": self.dur_sos_token.expand(batch_size, 1, self.dur_width),
+            "note_sos": note_sos.expand(batch_size, 1, self.note_emb_size),
+            "notes_init": notes_init,
+        }
+        if cells:
+            buffers.update(self.cell_weights(buffers))
+        return buffers
+
+    def cell_weights(self, buffers):
+        """
+        The weights of dec_notes_gru, dec_dur_gru and dur_hid_linear sliced for
+        infer_notes_cells. Their inputs are concatenations or tokens from small
+        tables, so the input projections are split by part and tabulated:
+        - notes_gi_table: the token part of dec_notes_gru's input projection of
+          every row of note_table, so a note token's projection is a lookup;
+        - dur_gi_table: dec_dur_gru's input projection of the sos token (row 0) and
+          of each one-hot duration token (rows 1 to dur_width).
+        """
+        notes_w_ih = self.dec_notes_gru.weight_ih_l0
+        token_w_ih = notes_w_ih[:, self.dec_time_hid_size :]
+        dur_tokens = torch.cat([self.dur_sos_token.unsqueeze(0), buffers["dur_tokens"]])
+        dur_hid_w = self.dur_hid_linear.weight
+        notes_gi_table = F.linear(buffers["note_table"], token_w_ih)
+        return {
+            "notes_summary_w_ih": notes_w_ih[:, : self.dec_time_hid_size],
+            "notes_gi_table": notes_gi_table,
+            "note_sos_gi": F.linear(buffers["note_sos"][0], token_w_ih),
+            "dur_gi_table": F.linear(
+                dur_tokens, self.dec_dur_gru.weight_ih_l0, self.dec_dur_gru.bias_ih_l0
+            ),
+            "dur_hid_summary_w": dur_hid_w[:, : self.dec_notes_hid_size],
+            "dur_hid_pitch_w": dur_hid_w[:, self.dec_notes_hid_size :],
+        }
+
+    def decode_note(self, note_summary, batch_size, buffers=None):
         # note_summary: (B, 1, dec_notes_hid_size)
         # This function estimate pitch, and dur for a single pitch based on
         # note_summary.
         # Returns: est_pitch (B, 1, pitch_range), est_durs (B, 1, dur_width, 2)
+        if buffers is None:
+            buffers = self.decoding_buffers(batch_size)
 
         # The estimated pitch is calculated by a linear layer.
         est_pitch = self.pitch_out_linear(note_summary).squeeze(1)
@@ -166,45 +243,46 @@ class PianoTreeDecoder(nn.Module):
         dur_hid = self.dur_hid_linear(
             torch.cat([dur_hid, est_pitch.unsqueeze(0)], dim=-1)
         )
-        token = self.dur_sos_token.repeat(batch_size, 1).unsqueeze(1)
+        token = buffers["dur_sos"][: batch_size]
         # token: (B, 1, dur_width)
 
-        est_durs = torch.zeros(batch_size, self.dur_width, 2)
-        est_durs = est_durs.to(self.device)
-
+        est_durs = []
         for t in range(self.dur_width):
             token, dur_hid = self.dec_dur_gru(token, dur_hid)
             est_dur = self.dur_out_linear(token).squeeze(1)
-            est_durs[:, t] = est_dur
+            est_durs.append(est_dur)
             if t == self.dur_width - 1:
                 break
             token_inds = est_dur.max(1)[1]
-            token = self.dur_ind_to_dur_token(token_inds, batch_size).unsqueeze(1)
-        return est_pitch, est_durs
+            token = buffers["dur_tokens"][token_inds].unsqueeze(1)
+        return est_pitch, torch.stack(est_durs, dim=1)
 
     def decode_notes(
-        self, notes_summary, batch_size, notes, inference, teacher_forcing_ratio=0.5
+        self,
+        notes_summary,
+        batch_size,
+        notes,
+        inference,
+        teacher_forcing_ratio=0.5,
+        buffers=None,
     ):
         # notes_summary: (B, 1, dec_time_hid_size)
         # notes: (B, max_simu_note, note_emb_size), ground_truth
+        # buffers: `decoding_buffers(batch_size)`, built here if not given
+        if buffers is None:
+            buffers = self.decoding_buffers(batch_size)
         notes_summary_hid = self.dec_time_to_notes_hid(notes_summary.transpose(0, 1))
         if inference:
             assert teacher_forcing_ratio == 0
             assert notes is None
-            sos = self.get_sos_token()  # (note_size,)
-            token = self.note_embedding(sos).repeat(batch_size, 1).unsqueeze(1)
+        predicted_notes = buffers["notes_init"].clone()
+        if notes is None:
+            token = buffers["note_sos"]
             # hid: (B, 1, note_emb_size)
         else:
             token = notes[:, 0].unsqueeze(1)
-
-        predicted_notes = torch.zeros(
-            batch_size, self.max_simu_note, self.note_emb_size
-        )
-        predicted_notes[:, :, self.pitch_range :] = 2.0
-        predicted_notes[:, 0] = token.squeeze(1)  # fill sos index
-        lengths = torch.zeros(batch_size)
-        predicted_notes = predicted_notes.to(self.device)
-        lengths = lengths.to(self.device)
+            predicted_notes[:, 0] = token.squeeze(1)  # fill sos index
+        lengths = torch.zeros(batch_size, device=self.device)
         pitch_outs = []
         dur_outs = []
 
@@ -215,22 +293,22 @@ class PianoTreeDecoder(nn.Module):
             # note_summary: (B, 1, dec_notes_hid_size)
             # notes_summary_hid: (1, B, dec_time_hid_size)
 
-            est_pitch, est_durs = self.decode_note(note_summary, batch_size)
+            est_pitch, est_durs = self.decode_note(note_summary, batch_size, buffers)
             # est_pitch: (B, pitch_range)
             # est_durs: (B, dur_width, 2)
 
-            pitch_outs.append(est_pitch.unsqueeze(1))
-            dur_outs.append(est_durs.unsqueeze(1))
+            pitch_outs.append(est_pitch)
+            dur_outs.append(est_durs)
             pitch_inds = est_pitch.max(1)[1]
             dur_inds = est_durs.max(2)[1]
-            predicted = self.pitch_dur_ind_to_note_token(
-                pitch_inds, dur_inds, batch_size
+            predicted = self.embed_note_inds(
+                pitch_inds, dur_inds, buffers["note_table"], buffers["dur_powers"]
             )
-            # predicted: (B, note_size)
+            # predicted: (B, note_emb_size)
 
             predicted_notes[:, t] = predicted
             eos_samp_inds = pitch_inds == self.pitch_eos
-            lengths[eos_samp_inds & (lengths == 0)] = t
+            lengths.masked_fill_(eos_samp_inds & (lengths == 0), t)
 
             if t == self.max_simu_note - 1:
                 break
@@ -239,16 +317,214 @@ class PianoTreeDecoder(nn.Module):
                 token = predicted.unsqueeze(1)
             else:
                 token = notes[:, t].unsqueeze(1)
-        lengths[lengths == 0] = t
-        pitch_outs = torch.cat(pitch_outs, dim=1)
-        dur_outs = torch.cat(dur_outs, dim=1)
+        lengths.masked_fill_(lengths == 0, t)
+        pitch_outs = torch.stack(pitch_outs, dim=1)
+        dur_outs = torch.stack(dur_outs, dim=1)
+        return pitch_outs, dur_outs, predicted_notes, lengths
+
+    def infer_notes(self, notes_summary, batch_size, buffers=None):
+        """
+        decode_notes at inference, which only decodes the rows that have not emitted
+        pitch_eos yet, and stops once every row has. Up to and including each row's
+        first eos, outputs match decode_notes, and so do predicted_notes and lengths,
+        hence the next time step. Afterwards est_pitch is eos and est_durs are zero
+        logits, where decode_notes goes on emitting notes that estx_to_midi_file
+        writes, so est_x differs: only used when opted in with early_exit.
+        """
+        # notes_summary: (B, 1, dec_time_hid_size)
+        if buffers is None:
+            buffers = self.decoding_buffers(batch_size)
+        notes_summary_hid = self.dec_time_to_notes_hid(notes_summary.transpose(0, 1))
+        token = buffers["note_sos"]
+
+        predicted_notes = buffers["notes_init"].clone()
+        lengths = torch.zeros(batch_size, device=self.device)
+        pitch_outs = torch.zeros(
+            batch_size,
+            self.max_simu_note - 1,
+            self.pitch_range,
+            device=self.device,
+        )
+        pitch_outs[:, :, self.pitch_eos] = 1.0
+        dur_outs = torch.zeros(
+            batch_size,
+            self.max_simu_note - 1,
+            self.dur_width,
+            2,
+            device=self.device,
+        )
+        # rows still decoding
+        active = torch.arange(batch_size, device=self.device)
+
+        for t in range(1, self.max_simu_note):
+            num_active = active.size(0)
+            note_summary, notes_summary_hid = self.dec_notes_gru(
+                torch.cat([notes_summary[active], token], dim=-1), notes_summary_hid
+            )
+            est_pitch, est_durs = self.decode_note(note_summary, num_active, buffers)
+            pitch_outs[active, t - 1] = est_pitch
+            dur_outs[active, t - 1] = est_durs
+            pitch_inds = est_pitch.max(1)[1]
+            dur_inds = est_durs.max(2)[1]
+            predicted = self.embed_note_inds(
+                pitch_inds, dur_inds, buffers["note_table"], buffers["dur_powers"]
+            )
+            predicted_notes[active, t] = predicted
+
+            eos_samp_inds = pitch_inds == self.pitch_eos
+            lengths.index_fill_(0, active[eos_samp_inds], t)
+            running = ~eos_samp_inds
+            if t == self.max_simu_note - 1 or not running.any():
+                break
+            active = active[running]
+            token = predicted[running].unsqueeze(1)
+            notes_summary_hid = notes_summary_hid[:, running]
+        lengths.masked_fill_(lengths == 0, self.max_simu_note - 1)
+        return pitch_outs, dur_outs, predicted_notes, lengths
+
+    def decode_note_cells(self, note_summary, buffers):
+        """decode_note on note_summary (N, dec_notes_hid_size) with gru_cell"""
+        est_pitch = self.pitch_out_linear(note_summary)
+        dur_hid = F.linear(
+            note_summary, buffers["dur_hid_summary_w"], self.dur_hid_linear.bias
+        )
+        dur_hid = dur_hid + F.linear(est_pitch, buffers["dur_hid_pitch_w"])
+        gi = buffers["dur_gi_table"][0].expand(note_summary.size(0), -1)
+
+        est_durs = []
+        for t in range(self.dur_width):
+            dur_hid = gru_cell(
+                gi, dur_hid, self.dec_dur_gru.weight_hh_l0, self.dec_dur_gru.bias_hh_l0
+            )
+            est_dur = self.dur_out_linear(dur_hid)
+            est_durs.append(est_dur)
+            if t == self.dur_width - 1:
+                break
+            gi = buffers["dur_gi_table"][est_dur.max(1)[1] + 1]
+        return est_pitch, torch.stack(est_durs, dim=1)
+
+    def infer_notes_cells(self, notes_summary, batch_size, buffers=None):
+        """
+        decode_notes at inference with the note and duration GRUs run by gru_cell.
+        The input projection of notes_summary is computed once per step rather than
+        once per note, and those of the tokens are looked up, see cell_weights.
+        Every row runs through every note, as in decode_notes, unless early_exit,
+        which drops the rows that have emitted eos as infer_notes does.
+        """
+        # notes_summary: (B, 1, dec_time_hid_size)
+        if buffers is None:
+            buffers = self.decoding_buffers(batch_size, cells=True)
+        notes_summary = notes_summary.squeeze(1)
+        hid = self.dec_time_to_notes_hid(notes_summary)
+        summary_gi = F.linear(
+            notes_summary, buffers["notes_summary_w_ih"], self.dec_notes_gru.bias_ih_l0
+        )
+        token_gi = buffers["note_sos_gi"]
+
+        predicted_notes = buffers["notes_init"].clone()
+        lengths = torch.zeros(batch_size, device=self.device)
+        pitch_outs = torch.zeros(
+            batch_size,
+            self.max_simu_note - 1,
+            self.pitch_range,
+            device=self.device,
+        )
+        pitch_outs[:, :, self.pitch_eos] = 1.0
+        dur_outs = torch.zeros(
+            batch_size,
+            self.max_simu_note - 1,
+            self.dur_width,
+            2,
+            device=self.device,
+        )
+        # rows still decoding
+        active = torch.arange(batch_size, device=self.device)
+
+        for t in range(1, self.max_simu_note):
+            hid = gru_cell(
+                summary_gi + token_gi,
+                hid,
+                self.dec_notes_gru.weight_hh_l0,
+                self.dec_notes_gru.bias_hh_l0,
+            )
+            est_pitch, est_durs = self.decode_note_cells(hid, buffers)
+            pitch_outs[active, t - 1] = est_pitch
+            dur_outs[active, t - 1] = est_durs
+            pitch_inds = est_pitch.max(1)[1]
+            dur_inds = est_durs.max(2)[1]
+            table_inds = self.note_table_inds(
+                pitch_inds, dur_inds, buffers["dur_powers"]
+            )
+            predicted_notes[active, t] = F.embedding_bag(
+                table_inds, buffers["note_table"], mode="sum"
+            )
+
+            # lengths at the first eos of each row
+            eos_samp_inds = pitch_inds == self.pitch_eos
+            first_eos = eos_samp_inds & (lengths[active] == 0)
+            lengths.index_fill_(0, active[first_eos], t)
+            if t == self.max_simu_note - 1:
+                break
+            if self.early_exit:
+                running = ~eos_samp_inds
+                if not running.any():
+                    break
+                active = active[running]
+                summary_gi = summary_gi[running]
+                hid = hid[running]
+                table_inds = table_inds[running]
+            token_gi = F.embedding_bag(
+                table_inds, buffers["notes_gi_table"], mode="sum"
+            )
+        lengths.masked_fill_(lengths == 0, self.max_simu_note - 1)
         return pitch_outs, dur_outs, predicted_notes, lengths
 
+    def summarize_notes(self, notes, lengths):
+        """Final states of dec_notes_emb_gru over the first `lengths` notes"""
+        # notes: (N, max_simu_note, note_emb_size)
+        # returns: (N, 2 * dec_emb_hid_size)
+        if self.pack_free:
+            summary = masked_gru_final_states(
+                self.dec_notes_emb_gru, notes, lengths.long()
+            )
+        else:
+            summary = pack_padded_sequence(
+                notes, lengths.view(-1).cpu(), batch_first=True, enforce_sorted=False
+            )
+            summary = self.dec_notes_emb_gru(summary)[-1]
+        return summary.transpose(0, 1).reshape(-1, 2 * self.dec_emb_hid_size)
+
+    def summarize_x(self, x, lengths):
+        """Summarize the embedded notes of each step by dec_notes_emb_gru"""
+        # x: (B, num_step, max_simu_note, note_emb_size)
+        # returns x_summarized: (B, num_step, 2 * dec_emb_hid_size)
+        x_summarized = x.view(-1, self.max_simu_note, self.note_emb_size)
+        x_summarized = self.summarize_notes(x_summarized, lengths)
+        x_summarized = x_summarized.view(-1, self.num_step, 2 * self.dec_emb_hid_size)
+        return x_summarized
+
+    def teacher_forcing_inputs(self, x):
+        """
+        The teacher-forcing inputs of pianotree x, which only depend on x and the
+        frozen weights: embedded notes, lengths and x_summarized.
+        """
+        embedded, lengths = self.emb_x(x)
+        return embedded, lengths, self.summarize_x(embedded, lengths)
+
     def decoder(
-        self, z, inference, x, lengths, teacher_forcing_ratio1, teacher_forcing_ratio2
+        self,
+        z,
+        inference,
+        x,
+        lengths,
+        teacher_forcing_ratio1,
+        teacher_forcing_ratio2,
+        x_summarized=None,
     ):
         # z: (B, z_size)
         # x: (B, num_step, max_simu_note, note_emb_size)
+        # x_summarized: precomputed `summarize_x(x, lengths)`, if given, x and
+        #     lengths are only used for note-level teacher forcing
         batch_size = z.size(0)
         z_hid = self.z2dec_hid_linear(z).unsqueeze(0)
         # z_hid: (1, B, dec_time_hid_size)
@@ -260,38 +536,53 @@ class PianoTreeDecoder(nn.Module):
             assert lengths is None
             assert teacher_forcing_ratio1 == 0
             assert teacher_forcing_ratio2 == 0
-        else:
-            x_summarized = x.view(-1, self.max_simu_note, self.note_emb_size)
-            x_summarized = pack_padded_sequence(
-                x_summarized,
-                lengths.view(-1).cpu(),
-                batch_first=True,
-                enforce_sorted=False,
-            )
-            x_summarized = (
-                self.dec_notes_emb_gru(x_summarized)[-1].transpose(0, 1).contiguous()
-            )
-            x_summarized = x_summarized.view(
-                -1, self.num_step, 2 * self.dec_emb_hid_size
-            )
+        elif x_summarized is None:
+            x_summarized = self.summarize_x(x, lengths)
+        if x is None:
+            # notes are only needed for note-level teacher forcing
+            assert teacher_forcing_ratio2 == 0
+        full_teacher_forcing = teacher_forcing_ratio1 == teacher_forcing_ratio2 == 1
+        if not inference and full_teacher_forcing and self.parallel_teacher_forcing:
+            return self.teacher_forced_decoder(z, x, x_summarized)
 
         pitch_outs = []
         dur_outs = []
-        token = self.dec_init_input.repeat(batch_size, 1).unsqueeze(1)
+        cells = inference and self.cell_loops
+        buffers = self.decoding_buffers(batch_size, cells)
+        token = self.dec_init_input.expand(batch_size, 1, -1)
         # (B, 2 * dec_emb_hid_size)
 
         for t in range(self.num_step):
             notes_summary, z_hid = self.dec_time_gru(
                 torch.cat([token, z_in], dim=-1), z_hid
             )
-            if inference:
+            if cells:
+                (
+                    pitch_out,
+                    dur_out,
+                    predicted_notes,
+                    predicted_lengths,
+                ) = self.infer_notes_cells(notes_summary, batch_size, buffers)
+            elif inference and self.early_exit:
+                (
+                    pitch_out,
+                    dur_out,
+                    predicted_notes,
+                    predicted_lengths,
+                ) = self.infer_notes(notes_summary, batch_size, buffers)
+            elif inference:
                 (
                     pitch_out,
                     dur_out,
                     predicted_notes,
                     predicted_lengths,
                 ) = self.decode_notes(
-                    notes_summary, batch_size, None, inference, teacher_forcing_ratio2
+                    notes_summary,
+                    batch_size,
+                    None,
+                    inference,
+                    teacher_forcing_ratio2,
+                    buffers,
                 )
             else:
                 (
@@ -302,12 +593,13 @@ class PianoTreeDecoder(nn.Module):
                 ) = self.decode_notes(
                     notes_summary,
                     batch_size,
-                    x[:, t],
+                    None if x is None else x[:, t],
                     inference,
                     teacher_forcing_ratio2,
+                    buffers,
                 )
-            pitch_outs.append(pitch_out.unsqueeze(1))
-            dur_outs.append(dur_out.unsqueeze(1))
+            pitch_outs.append(pitch_out)
+            dur_outs.append(dur_out)
             if t == self.num_step - 1:
                 break
 
@@ -315,25 +607,70 @@ class PianoTreeDecoder(nn.Module):
             if teacher_force and not inference:
                 token = x_summarized[:, t].unsqueeze(1)
             else:
-                token = pack_padded_sequence(
-                    predicted_notes,
-                    predicted_lengths.cpu(),
-                    batch_first=True,
-                    enforce_sorted=False,
-                )
-                token = self.dec_notes_emb_gru(token)[-1].transpose(0, 1).contiguous()
-                token = token.view(-1, 2 * self.dec_emb_hid_size).unsqueeze(1)
-        pitch_outs = torch.cat(pitch_outs, dim=1)
-        dur_outs = torch.cat(dur_outs, dim=1)
+                token = self.summarize_notes(predicted_notes, predicted_lengths)
+                token = token.unsqueeze(1)
+        pitch_outs = torch.stack(pitch_outs, dim=1)
+        dur_outs = torch.stack(dur_outs, dim=1)
         # print(pitch_outs.size())
         # print(dur_outs.size())
         return pitch_outs, dur_outs
 
+    def teacher_forced_decoder(self, z, x, x_summarized):
+        """
+        decoder with teacher_forcing_ratio1 = teacher_forcing_ratio2 = 1. Every input
+        of dec_time_gru and dec_notes_gru is then known up front, so each runs once
+        over whole sequences, and the duration loop runs once for all notes.
+        """
+        # z: (B, z_size)
+        # x: (B, num_step, max_simu_note, note_emb_size)
+        # x_summarized: (B, num_step, 2 * dec_emb_hid_size)
+        batch_size = z.size(0)
+        z_hid = self.z2dec_hid_linear(z).unsqueeze(0)
+        z_in = self.z2dec_in_linear(z).unsqueeze(1)
+        tokens = torch.cat(
+            [self.dec_init_input.expand(batch_size, 1, -1), x_summarized[:, :-1]],
+            dim=1,
+        )
+        tokens = torch.cat([tokens, z_in.expand(-1, self.num_step, -1)], dim=-1)
+        notes_summary, _ = self.dec_time_gru(tokens, z_hid)
+        # notes_summary: (B * num_step, 1, dec_time_hid_size)
+        notes_summary = notes_summary.reshape(-1, 1, self.dec_time_hid_size)
+        notes_summary_hid = self.dec_time_to_notes_hid(notes_summary.transpose(0, 1))
+
+        # the note tokens of steps 1, ..., max_simu_note - 1: the notes before
+        notes = x.reshape(-1, self.max_simu_note, self.note_emb_size)[:, :-1]
+        notes = torch.cat(
+            [notes_summary.expand(-1, self.max_simu_note - 1, -1), notes], dim=-1
+        )
+        note_summary, _ = self.dec_notes_gru(notes, notes_summary_hid)
+        note_summary = note_summary.reshape(-1, 1, self.dec_notes_hid_size)
+        num_notes = note_summary.size(0)
+        buffers = {
+            "dur_tokens": torch.eye(self.dur_width, device=self.device),
+            "dur_sos": self.dur_sos_token.expand(num_notes, 1, self.dur_width),
+        }
+        est_pitch, est_durs = self.decode_note(note_summary, num_notes, buffers)
+        pitch_outs = est_pitch.view(
+            batch_size, self.num_step, self.max_simu_note - 1, self.pitch_range
+        )
+        dur_outs = est_durs.view(
+            batch_size, self.num_step, self.max_simu_note - 1, self.dur_width, 2
+        )
+        return pitch_outs, dur_outs
+
     def forward(
-        self, z, inference, x, lengths, teacher_forcing_ratio1, teacher_forcing_ratio2
+        self,
+        z,
+        inference,
+        x,
+        lengths,
+        teacher_forcing_ratio1,
+        teacher_forcing_ratio2,
+        x_summarized=None,
     ):
         return self.decoder(
-            z, inference, x, lengths, teacher_forcing_ratio1, teacher_forcing_ratio2
+            z, inference, x, lengths, teacher_forcing_ratio1, teacher_forcing_ratio2,
+            x_summarized
         )
 
     def recon_loss(
@@ -366,8 +703,7 @@ class PianoTreeDecoder(nn.Module):
 
     def emb_x(self, x):
         lengths = self.get_len_index_tensor(x)
-        x = self.index_tensor_to_multihot_tensor(x)
-        embedded = self.note_embedding(x)
+        embedded = self.embed_index_tensor(x)
         return embedded, lengths
 
     def output_to_numpy(self, recon_pitch, recon_dur):
@@ -379,35 +715,95 @@ class PianoTreeDecoder(nn.Module):
         recon_dur = recon_dur.cpu().numpy()
         return est_x, recon_pitch, recon_dur
 
-    def pr_to_notes(self, pr, bpm=80, start=0.0, one_hot=False):
-        pr_matrix = self.pr_to_pr_matrix(pr, one_hot)
+    def pr_to_note_arrays(self, pr_matrix, bpm=80, start=0.0):
+        """
+        The notes of duration matrices (N, 32, 128) (or one (32, 128)), numpy or
+        torch, holding at each (step, pitch) the duration in steps of the note
+        starting there, 0 for none: pitch, onset and offset in seconds (segment n
+        starts 32 steps after segment n - 1), and seg, arrays of the same kind.
+        """
+        is_numpy = isinstance(pr_matrix, np.ndarray)
+        pr_matrix = torch.as_tensor(pr_matrix)
+        shape = tuple(pr_matrix.shape)
+        if len(shape) not in (2, 3) or shape[-2 :] != (self.num_step, 128):
+            raise ValueError(
+                f"expected duration matrices (N, {self.num_step}, 128), got {shape}"
+            )
+        pr_matrix = pr_matrix.reshape(-1, *pr_matrix.shape[-2 :])
+        alpha = 0.25 * 60 / bpm
+        seg, step, pitch = (pr_matrix >= 1).nonzero(as_tuple=True)
+        # times in float64, as python floats
+        t = (seg * pr_matrix.size(1) + step).double()
+        onset = alpha * t + start
+        offset = alpha * (t + pr_matrix[seg, step, pitch]) + start
+        out = pitch, onset, offset, seg
+        return tuple(x.numpy() for x in out) if is_numpy else out
+
+    def pr_to_notes(self, pr_matrix, bpm=80, start=0.0):
+        """pretty_midi notes of `pr_to_note_arrays`"""
+        pitch, onset, offset, _ = self.pr_to_note_arrays(pr_matrix, bpm, start)
+        return [
+            pretty_midi.Note(100, p, s, e)
+            for p, s, e in zip(pitch.tolist(), onset.tolist(), offset.tolist())
+        ]
+
+    def grid_to_note_arrays(self, grids, max_notes=None):
+        """
+        The notes of grids (N, 32, max_simu_note or max_simu_note - 1, 6), numpy or
+        torch, in grid order: those before the first eos of each step, within its
+        first max_notes slots. Returns seg, step, pitch and dur (in steps), arrays
+        of the same kind.
+        """
+        is_numpy = isinstance(grids, np.ndarray)
+        grids = torch.as_tensor(grids)
+        if grids.shape[2] == self.max_simu_note:
+            grids = grids[:, :, 1 :]
+        if max_notes is not None:
+            grids = grids[:, :, : max_notes]
+        pitch = grids[..., 0]
+        valid = (pitch == self.pitch_eos).cumsum(-1) == 0
+        # sos and pad before eos are not notes either
+        valid &= pitch <= self.max_pitch - self.min_pitch
+        seg, step, _ = valid.nonzero(as_tuple=True)
+        notes = grids[valid]
+        bits = 2**torch.arange(self.dur_width - 1, -1, -1, device=grids.device)
+        dur = (notes[:, 1 :] * bits).sum(-1) + 1
+        out = seg, step, notes[:, 0] + self.min_pitch, dur
+        return tuple(x.numpy() for x in out) if is_numpy else out
+
+    def grid_to_pr_and_note_arrays(self, grids, bpm=60.0, start=0.0, max_notes=None):
+        """
+        Piano rolls (N, 32, 128) of grids (N, 32, max_simu_note(-1), 6), numpy or
+        torch, holding the duration of each onset clipped to the segment (the last
+        note wins when a step repeats a pitch), and their notes (see
+        grid_to_note_arrays) as pitch, onset, offset (seconds, segment n starting 32
+        steps after segment n - 1) and seg, of the same kind.
+        """
+        is_numpy = isinstance(grids, np.ndarray)
+        grids = torch.as_tensor(grids)
+        seg, step, pitch, dur = self.grid_to_note_arrays(grids, max_notes)
+        num_step = grids.size(1)
+        device = grids.device
+        pr = torch.zeros(len(grids), num_step, 128, dtype=torch.long, device=device)
+        cells = (seg * num_step + step) * 128 + pitch
+        last = torch.full((pr.numel(),), -1, device=device)
+        positions = torch.arange(len(cells), device=device)
+        last = last.scatter_reduce(0, cells, positions, "amax")
+        filled = last >= 0
+        pr.view(-1)[filled] = torch.minimum(dur, num_step - step)[last[filled]]
+
         alpha = 0.25 * 60 / bpm
-        notes = []
-        for t in range(32):
-            for p in range(128):
-                if pr_matrix[t, p] >= 1:
-                    s = alpha * t + start
-                    e = alpha * (t + pr_matrix[t, p]) + start
-                    notes.append(pretty_midi.Note(100, int(p), s, e))
-        return notes
+        t = (seg * num_step + step).double()
+        out = pr, pitch, start + t * alpha, start + (t + dur) * alpha, seg
+        return tuple(x.numpy() for x in out) if is_numpy else out
 
     def grid_to_pr_and_notes(self, grid, bpm=60.0, start=0.0):
-        if grid.shape[1] == self.max_simu_note:
-            grid = grid[:, 1 :]
-        pr = np.zeros((32, 128), dtype=int)
-        alpha = 0.25 * 60 / bpm
-        notes = []
-        for t in range(32):
-            for n in range(10):
-                note = grid[t, n]
-                if note[0] == self.pitch_eos:
-                    break
-                pitch = note[0] + self.min_pitch
-                dur = int("".join([str(_) for _ in note[1 :]]), 2) + 1
-                pr[t, pitch] = min(dur, 32 - t)
-                notes.append(
-                    pretty_midi.Note(
-                        80, int(pitch), start + t * alpha, start + (t + dur) * alpha
-                    )
-                )
-        return pr, notes
+        # only the first 10 notes of each step
+        pr, pitch, onset, offset, _ = self.grid_to_pr_and_note_arrays(
+            np.asarray(grid)[None], bpm, start, max_notes=10
+        )
+        notes = [
+            pretty_midi.Note(80, p, s, e)
+            for p, s, e in zip(pitch.tolist(), onset.tolist(), offset.tolist())
+        ]
+        return pr[0], notes
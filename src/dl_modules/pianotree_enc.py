@@ -2,6 +2,8 @@ from torch import nn
 import torch
 from torch.nn.utils.rnn import pack_padded_sequence
 from torch.distributions import Normal
+from .masked_gru import masked_gru_final_states
+from .note_tables import embed_note_inds, note_embedding_table
 
 
 class PianoTreeEncoder(nn.Module):
@@ -21,6 +23,7 @@ class PianoTreeEncoder(nn.Module):
         enc_notes_hid_size=256,
         enc_time_hid_size=512,
         z_size=512,
+        pack_free=False,
     ):
         super(PianoTreeEncoder, self).__init__()
 
@@ -45,6 +48,8 @@ class PianoTreeEncoder(nn.Module):
         self.z_size = z_size
         self.enc_notes_hid_size = enc_notes_hid_size
         self.enc_time_hid_size = enc_time_hid_size
+        # run enc_notes_gru on the padded notes, see masked_gru_final_states
+        self.pack_free = pack_free
 
         self.note_embedding = nn.Linear(self.note_size, note_emb_size)
         self.enc_notes_gru = nn.GRU(
@@ -69,6 +74,8 @@ class PianoTreeEncoder(nn.Module):
         with torch.no_grad():
             lengths = self.max_simu_note - (ind_x[:, :, :, 0] - self.pitch_pad
                                             == 0).sum(dim=-1)
+        if self.pack_free:
+            return lengths
         return lengths.to("cpu")
 
     def index_tensor_to_multihot_tensor(self, ind_x):
@@ -89,15 +96,37 @@ class PianoTreeEncoder(nn.Module):
             out = torch.cat([out[:, :, :, 0 : self.pitch_range], dur_part], dim=-1)
         return out
 
+    def embed_index_tensor(self, ind_x):
+        """
+        note_embedding(index_tensor_to_multihot_tensor(ind_x)) without the
+        multi-hot tensor. Each note sums two rows of a small table: its pitch column
+        of the weight, and the projection (with bias) of its duration bits, see
+        note_tables.py.
+        """
+        # ind_x: (B, 32, max_simu_note, 1 + dur_width)
+        table, powers = note_embedding_table(
+            self.note_embedding, self.pitch_range, self.dur_width
+        )
+        return embed_note_inds(
+            ind_x[:, :, :, 0], ind_x[:, :, :, 1 :], table, powers, self.pitch_range
+        )
+
     def encoder(self, x, lengths):
         embedded = self.note_embedding(x)
-        # x: (B, num_step, max_simu_note, note_emb_size)
+        return self.encode_embedded(embedded, lengths), embedded
+
+    def encode_embedded(self, embedded, lengths):
+        # embedded: (B, num_step, max_simu_note, note_emb_size)
         # now x are notes
         x = embedded.view(-1, self.max_simu_note, self.note_emb_size)
-        x = pack_padded_sequence(
-            x, lengths.view(-1), batch_first=True, enforce_sorted=False
-        )
-        x = self.enc_notes_gru(x)[-1].transpose(0, 1).contiguous()
+        if self.pack_free:
+            x = masked_gru_final_states(self.enc_notes_gru, x, lengths)
+        else:
+            x = pack_padded_sequence(
+                x, lengths.view(-1).cpu(), batch_first=True, enforce_sorted=False
+            )
+            x = self.enc_notes_gru(x)[-1]
+        x = x.transpose(0, 1).contiguous()
         x = x.view(-1, self.num_step, 2 * self.enc_notes_hid_size)
         # now, x is simu_notes.
         x = self.enc_time_gru(x)[-1].transpose(0, 1).contiguous()
@@ -106,12 +135,12 @@ class PianoTreeEncoder(nn.Module):
         mu = self.linear_mu(x)  # (B, z_size)
         std = self.linear_std(x).exp_()  # (B, z_size)
         dist = Normal(mu, std)
-        return dist, embedded
+        return dist
 
     def forward(self, x, return_iterators=False):
         lengths = self.get_len_index_tensor(x)
-        x = self.index_tensor_to_multihot_tensor(x)
-        dist, embedded_x = self.encoder(x, lengths)
+        embedded_x = self.embed_index_tensor(x)
+        dist = self.encode_embedded(embedded_x, lengths)
         if return_iterators:
             return dist.mean, dist.scale, embedded_x
         else:
@@ -0,0 +1,171 @@
+"""
+Per-segment features of the frozen PianoTree encoder/decoder, cached on disk.
+
+A store keeps, for every segment of a dataset and every pitch shift in SHIFTS, one
+entry per field, in memory-mapped arrays:
+    <field>.npy: (num_segs, len(SHIFTS), *shape)
+    meta.json: fingerprint of the pretrained checkpoint, of the dataset (its
+        `fingerprint()`: songs, their order and versions), num_segs, fields
+Entry [i, s] holds the features of segment i transposed by
+`clamp_pitch_shifts(..., SHIFTS[s])`, so the shifts drawn by
+`dataloader.pitch_shift_augment` can be looked up directly.
+A store whose fingerprints differ from the current checkpoint or dataset is
+recomputed.
+"""
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from functools import partial
+from dataloader import IndexedDataset, collate_fn, clamp_pitch_shifts
+from utils import pianotree_batch_pitch_shift
+import hashlib
+import json
+import os
+import numpy as np
+import torch
+
+SHIFTS = np.arange(-6, 6)
+
+
+def file_fingerprint(fpath):
+    """sha1 of a file's content"""
+    sha1 = hashlib.sha1()
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class SegmentFeatureStore:
+    # field name -> (shape of one entry, dtype), defined by subclasses
+    FIELDS = {}
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.meta_fpath = os.path.join(store_dir, "meta.json")
+        self.arrays = None
+
+    def _field_fpath(self, name):
+        return os.path.join(self.store_dir, f"{name}.npy")
+
+    def is_valid(self, fingerprint, data_fingerprint, num_segs):
+        if not os.path.exists(self.meta_fpath):
+            return False
+        with open(self.meta_fpath) as f:
+            meta = json.load(f)
+        return meta == self._meta(fingerprint, data_fingerprint, num_segs)
+
+    def _meta(self, fingerprint, data_fingerprint, num_segs):
+        return {
+            "fingerprint": fingerprint,
+            "data_fingerprint": data_fingerprint,
+            "num_segs": num_segs,
+            "shifts": SHIFTS.tolist(),
+            "fields": {
+                name: [list(shape), np.dtype(dtype).str]
+                for name, (shape, dtype) in self.FIELDS.items()
+            },
+        }
+
+    def open(self):
+        self.arrays = {
+            name: np.load(self._field_fpath(name), mmap_mode="r")
+            for name in self.FIELDS
+        }
+        return self
+
+    def read(self, indices, shifts):
+        """
+        Gather entries of segments `indices` at pitch `shifts` (B,).
+        Return a dict of field -> (B, *shape) tensors.
+        """
+        indices = indices.cpu().numpy()
+        slots = shifts.cpu().numpy() - SHIFTS[0]
+        return {
+            name: torch.from_numpy(np.ascontiguousarray(array[indices, slots]))
+            for name, array in self.arrays.items()
+        }
+
+    def compute_features(self, model, pnotree_x, pnotree_y):
+        """Return a dict of field -> (B, *shape) features of a batch, by subclasses"""
+        raise NotImplementedError
+
+    def build(
+        self, model, dataset, fingerprint, batch_size, num_workers=0,
+        data_fingerprint=None
+    ):
+        """Compute the features of every segment of `dataset` at every shift"""
+        if data_fingerprint is None:
+            data_fingerprint = dataset.fingerprint()
+        os.makedirs(self.store_dir, exist_ok=True)
+        if os.path.exists(self.meta_fpath):
+            os.remove(self.meta_fpath)
+        arrays = {
+            name: np.lib.format.open_memmap(
+                self._field_fpath(name), "w+", dtype,
+                (len(dataset), len(SHIFTS), *shape)
+            )
+            for name, (shape, dtype) in self.FIELDS.items()
+        }
+        dl = DataLoader(
+            IndexedDataset(dataset),
+            batch_size,
+            collate_fn=partial(collate_fn, with_index=True),
+            num_workers=num_workers,
+        )
+        device = next(model.parameters()).device
+        with torch.no_grad():
+            for pnotree_x, pnotree_y, indices in tqdm(dl, desc=self.store_dir):
+                pnotree_x, pnotree_y = pnotree_x.to(device), pnotree_y.to(device)
+                for slot, shift in enumerate(SHIFTS):
+                    shifts = torch.full_like(indices, shift).to(device)
+                    shifts = clamp_pitch_shifts(pnotree_x, pnotree_y, shifts)
+                    features = self.compute_features(
+                        model,
+                        pianotree_batch_pitch_shift(pnotree_x, shifts),
+                        pianotree_batch_pitch_shift(pnotree_y, shifts),
+                    )
+                    for name, feature in features.items():
+                        arrays[name][indices.numpy(), slot] = feature.cpu().numpy()
+        for array in arrays.values():
+            array.flush()
+
+        # the meta is written last: a store without it is incomplete
+        with open(self.meta_fpath, "w") as f:
+            json.dump(self._meta(fingerprint, data_fingerprint, len(dataset)), f)
+        return self.open()
+
+    def open_or_build(self, model, dataset, fingerprint, batch_size, num_workers=0):
+        data_fingerprint = dataset.fingerprint()
+        if self.is_valid(fingerprint, data_fingerprint, len(dataset)):
+            return self.open()
+        print(f"building {self.store_dir}...")
+        return self.build(
+            model, dataset, fingerprint, batch_size, num_workers, data_fingerprint
+        )
+
+
+class LatentStore(SegmentFeatureStore):
+    """mu and std of the frozen PianoTree encoder on pianotree_x"""
+    FIELDS = {
+        "mu": ((512,), np.float32),
+        "std": ((512,), np.float32),
+    }
+
+    def compute_features(self, model, pnotree_x, pnotree_y):
+        mu, std, _ = model.pnotree_enc(pnotree_x, return_iterators=True)
+        return {"mu": mu, "std": std}
+
+
+class SummaryStore(SegmentFeatureStore):
+    """
+    x_summarized of the frozen PianoTree decoder on pianotree_y, the teacher-forcing
+    input of its time-level GRU. Embedded notes are not stored: they are a cheap
+    linear map, only needed for note-level teacher forcing.
+    """
+    FIELDS = {
+        "y_summarized": ((32, 256), np.float32),
+    }
+
+    def compute_features(self, model, pnotree_x, pnotree_y):
+        _, _, y_summarized = model.pnotree_dec.teacher_forcing_inputs(pnotree_y)
+        return {"y_summarized": y_summarized}
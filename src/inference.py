@@ -3,11 +3,18 @@ from os.path import join
 from argparse import ArgumentParser
 from params import params
 from datetime import datetime
-from dataset import DataSampleNpz
+from dataset import open_data_sample
 from dirs import *
-from utils import estx_to_midi_file
+from utils import estx_to_midi_file, read_dict, MidiStreamWriter
 from model import Diffpro
+from result_cache import DedupInference, InferenceResultCache, model_fingerprint
+from collections import deque
+from itertools import islice
+import multiprocessing
+import numpy as np
+import os
 import pickle
+import time
 
 
 def predict(model_dir, is_sampling=False):
@@ -29,17 +36,278 @@ def choose_song_from_val_dl():
     song_fn = split[1][num]
     print(song_fn)
 
-    song = DataSampleNpz(song_fn)
+    song = open_data_sample(song_fn)
     pnotree_x, pnotree_y = song.get_whole_song_data()
     estx_to_midi_file(pnotree_x, "exp/origin_x.mid")
     estx_to_midi_file(pnotree_y, "exp/origin_y.mid")
     return song_fn, pnotree_x, pnotree_y
 
 
+def _load_song(song_fn):
+    start = time.perf_counter()
+    pnotree_x, _ = open_data_sample(song_fn).get_whole_song_data()
+    return song_fn, pnotree_x.numpy(), time.perf_counter() - start
+
+
+class _SongOutput:
+    """The decoded segments of a song, filled batch by batch"""
+
+    def __init__(self, song_fn, num_segs, load_time):
+        self.song_fn = song_fn
+        self.est_x = []
+        self.remaining = num_segs
+        self.load_time = load_time
+        self.decode_time = 0.0
+        self.start = time.perf_counter()
+
+
+def open_dedup(model, model_dir, result_cache=None, cache_size=100000):
+    """
+    DedupInference of model, with the InferenceResultCache in the sqlite file
+    result_cache of the checkpoint in model_dir and the decoding params, if given
+    """
+    cache = None
+    if result_cache is not None:
+        cache = InferenceResultCache(
+            result_cache, model_fingerprint(model_dir, params), cache_size
+        )
+    return DedupInference(model, cache)
+
+
+def predict_songs(
+    model_dir,
+    song_fns,
+    out_dir,
+    batch_size=128,
+    num_workers=4,
+    is_sampling=False,
+    dedup=False,
+    result_cache=None,
+    cache_size=100000,
+    max_ahead=None,
+):
+    """
+    Render every song of song_fns to `out_dir/x_{song_fn}.mid`, without
+    interaction. Songs are loaded by a pool of num_workers processes ahead of the
+    model, at most max_ahead songs (2 * num_workers by default) loading or loaded
+    but not yet taken by the model, so memory does not grow with song_fns when
+    loading outpaces decoding. Their segments are packed into `Diffpro.infer`
+    batches of batch_size (the last one smaller), so small songs share batches and
+    long songs span several. Reports the load, decode (the song's share of its
+    batches) and total time of each song.
+    With dedup (or a result_cache, see `open_dedup`), repeated segments of a batch
+    are inferred once, and cached ones not at all.
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = Diffpro.load_trained(model_dir, params).to(device).eval()
+    os.makedirs(out_dir, exist_ok=True)
+    dedup = dedup or result_cache is not None
+    if dedup and is_sampling:
+        raise ValueError("dedup needs deterministic inference, is_sampling=False")
+    dedup_inference = None
+    if dedup:
+        dedup_inference = open_dedup(model, model_dir, result_cache, cache_size)
+
+    # (song output, segments) of the segments not yet batched
+    pending = []
+    num_pending = 0
+    num_segs = 0
+    start = time.perf_counter()
+
+    def run_batch(size):
+        nonlocal num_pending
+        pnotrees = []
+        parts = []
+        while size > 0:
+            song, pnotree_x = pending[0]
+            if len(pnotree_x) > size:
+                pending[0] = song, pnotree_x[size :]
+                pnotree_x = pnotree_x[: size]
+            else:
+                pending.pop(0)
+            pnotrees.append(pnotree_x)
+            parts.append((song, len(pnotree_x)))
+            size -= len(pnotree_x)
+        pnotree = torch.from_numpy(np.concatenate(pnotrees)).to(device)
+        num_pending -= len(pnotree)
+
+        batch_start = time.perf_counter()
+        if dedup_inference is not None:
+            est_x = dedup_inference.infer(pnotree)
+        else:
+            est_x, _, _ = model.infer(pnotree, is_sampling=is_sampling)
+        batch_time = time.perf_counter() - batch_start
+        offset = 0
+        for song, n in parts:
+            song.est_x.append(est_x[offset : offset + n])
+            song.decode_time += batch_time * n / len(pnotree)
+            song.remaining -= n
+            offset += n
+            if song.remaining == 0:
+                write_song(song)
+
+    def write_song(song):
+        fpath = join(out_dir, f"x_{song.song_fn}.mid")
+        # empty songs get an empty MIDI file too
+        est_x = np.concatenate(song.est_x) if len(song.est_x) > 0 else []
+        estx_to_midi_file(est_x, fpath)
+        print(
+            f"{song.song_fn}: {len(est_x)} segments, "
+            f"load {song.load_time:.2f}s, decode {song.decode_time:.2f}s, "
+            f"total {time.perf_counter() - song.start:.2f}s -> {fpath}"
+        )
+
+    if max_ahead is None:
+        max_ahead = 2 * num_workers
+    # loads submitted to the pool, in song order
+    loads = deque()
+    next_songs = iter(song_fns)
+
+    with multiprocessing.Pool(num_workers) as pool:
+
+        def load_ahead():
+            for song_fn in islice(next_songs, max_ahead - len(loads)):
+                loads.append(pool.apply_async(_load_song, (song_fn, )))
+
+        load_ahead()
+        while len(loads) > 0:
+            song_fn, pnotree_x, load_time = loads.popleft().get()
+            load_ahead()
+            song = _SongOutput(song_fn, len(pnotree_x), load_time)
+            if len(pnotree_x) == 0:
+                write_song(song)
+                continue
+            pending.append((song, pnotree_x))
+            num_pending += len(pnotree_x)
+            num_segs += len(pnotree_x)
+            while num_pending >= batch_size:
+                run_batch(batch_size)
+        if num_pending > 0:
+            run_batch(num_pending)
+
+    total = time.perf_counter() - start
+    print(
+        f"{len(song_fns)} songs, {num_segs} segments in {total:.1f}s "
+        f"({num_segs / total:.1f} segments/s)"
+    )
+    if dedup_inference is not None:
+        print(dedup_inference.stats())
+
+
+def stream_song(
+    model, song_fn, fpath, chunk_size=64, is_sampling=False, dedup_inference=None
+):
+    """
+    Render song_fn to fpath chunk_size segments at a time: the segments are read,
+    inferred and appended to the MIDI file a chunk at a time, so memory is bounded
+    by chunk_size rather than the song. A generator yielding (segments done, est_x
+    of the chunk) once the file holds all notes of the chunk.
+    Chunks go through dedup_inference (a DedupInference of model) if given.
+    """
+    song = open_data_sample(song_fn)
+    with MidiStreamWriter(fpath) as writer:
+        for pnotree_x in song.iter_whole_song_x(chunk_size):
+            pnotree_x = pnotree_x.to(model.device)
+            if dedup_inference is not None:
+                est_x = dedup_inference.infer(pnotree_x)
+            else:
+                est_x, _, _ = model.infer(pnotree_x, is_sampling=is_sampling)
+            writer.append_estx(est_x)
+            yield writer.num_segs, est_x
+
+
+def predict_songs_streaming(
+    model_dir,
+    song_fns,
+    out_dir,
+    chunk_size=64,
+    dedup=False,
+    result_cache=None,
+    cache_size=100000,
+):
+    """
+    Render every song of song_fns to `out_dir/x_{song_fn}.mid` with `stream_song`,
+    with dedup as in `predict_songs`
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = Diffpro.load_trained(model_dir, params).to(device).eval()
+    os.makedirs(out_dir, exist_ok=True)
+    dedup_inference = None
+    if dedup or result_cache is not None:
+        dedup_inference = open_dedup(model, model_dir, result_cache, cache_size)
+    for song_fn in song_fns:
+        fpath = join(out_dir, f"x_{song_fn}.mid")
+        start = time.perf_counter()
+        num_segs = 0
+        segs = stream_song(
+            model, song_fn, fpath, chunk_size, dedup_inference=dedup_inference
+        )
+        for num_segs, _ in segs:
+            print(
+                f"{song_fn}: {num_segs} segments, "
+                f"{time.perf_counter() - start:.2f}s -> {fpath}"
+            )
+        print(f"{song_fn}: done, {num_segs} segments")
+    if dedup_inference is not None:
+        print(dedup_inference.stats())
+
+
 if __name__ == "__main__":
     parser = ArgumentParser(description='inference a Diffpro model')
     parser.add_argument(
         "--model_dir", help='directory in which trained model checkpoints are stored'
     )
+    parser.add_argument(
+        "--songs", nargs="+", help='render these songs without interaction'
+    )
+    parser.add_argument(
+        "--split",
+        choices=["train", "valid"],
+        help='render every song of a split of split_dict.pickle without interaction'
+    )
+    parser.add_argument("--out_dir", default="exp/batch")
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument(
+        "--max_ahead", type=int, help='songs loaded ahead, 2 * num_workers by default'
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        help='stream each song in chunks of this many segments, one song at a time'
+    )
+    parser.add_argument(
+        "--dedup", action="store_true", help='infer repeated segments once'
+    )
+    parser.add_argument(
+        "--result_cache",
+        help='sqlite file caching results across runs, implies --dedup'
+    )
+    parser.add_argument(
+        "--cache_size", type=int, default=100000, help='entries of --result_cache'
+    )
     args = parser.parse_args()
-    predict(args.model_dir)
+    if args.songs is not None or args.split is not None:
+        song_fns = args.songs
+        if song_fns is None:
+            split = read_dict(join(TRAIN_SPLIT_DIR, "split_dict.pickle"))
+            song_fns = split[0 if args.split == "train" else 1]
+        if args.chunk_size is not None:
+            predict_songs_streaming(
+                args.model_dir, song_fns, args.out_dir, args.chunk_size, args.dedup,
+                args.result_cache, args.cache_size
+            )
+        else:
+            predict_songs(
+                args.model_dir,
+                song_fns,
+                args.out_dir,
+                args.batch_size,
+                args.num_workers,
+                dedup=args.dedup,
+                result_cache=args.result_cache,
+                cache_size=args.cache_size,
+                max_ahead=args.max_ahead,
+            )
+    else:
+        predict(args.model_dir)
@@ -7,14 +7,25 @@ from torch.utils.tensorboard.writer import SummaryWriter
 from os.path import join
 from datetime import datetime
 
-from dataloader import get_train_val_dataloaders
+from dataloader import get_train_val_dataloaders, pitch_shift_augment
 from dirs import *
 from model import Diffpro
+from feature_cache import LatentStore, SummaryStore, file_fingerprint
 from utils import nested_map
+from torch.distributions import Normal
 
 
 class DiffproLearner:
-    def __init__(self, output_dir, model, train_dl, val_dl, optimizer, params):
+    def __init__(
+        self,
+        output_dir,
+        model,
+        train_dl,
+        val_dl,
+        optimizer,
+        params,
+        feature_stores=None,
+    ):
         self.output_dir = output_dir
         self.log_dir = f"{output_dir}/logs"
         self.checkpoint_dir = f"{output_dir}/chkpts"
@@ -26,6 +37,8 @@ class DiffproLearner:
         self.val_dl = val_dl
         self.optimizer = optimizer
         self.params = params
+        # SegmentFeatureStore pairs of the train and val sets, replacing frozen work
+        self.feature_stores = feature_stores or []
 
         self.step = 0
         self.epoch = 0
@@ -134,17 +147,35 @@ class DiffproLearner:
 
         self.save_to_checkpoint()
 
+    def _cached_features(self, split, indices, shifts):
+        """Keyword arguments of `Diffpro.get_loss_dict` read from the feature stores"""
+        features = {}
+        for stores in self.feature_stores:
+            features.update(stores[split].read(indices, shifts))
+        features = nested_map(features, lambda x: x.to(self.device))
+        if "mu" in features:
+            features["dist_x"] = Normal(features.pop("mu"), features.pop("std"))
+        return features
+
     def train_step(self, batch):
         # people say this is the better way to set zero grad
         # instead of self.optimizer.zero_grad()
         for param in self.model.parameters():
             param.grad = None
 
-        pnotree_x, pnotree_y = batch
+        pnotree_x, pnotree_y = batch[: 2]
+        shifts = torch.zeros(pnotree_x.size(0), dtype=torch.long)
+        if self.params.pitch_shift_aug == "device":
+            pnotree_x, pnotree_y, shifts = pitch_shift_augment(pnotree_x, pnotree_y)
+        features = {}
+        if len(self.feature_stores) > 0:
+            features = self._cached_features(0, batch[-1], shifts)
 
         # here forward the model
         with self.autocast:
-            loss_dict = self.model.get_loss_dict(pnotree_x, pnotree_y)
+            loss_dict = self.model.get_loss_dict(
+                pnotree_x, pnotree_y, self.params.tfr1, self.params.tfr2, **features
+            )
 
         loss = loss_dict["loss"]
         self.scaler.scale(loss).backward()
@@ -158,21 +189,49 @@ class DiffproLearner:
 
     def val_step(self, batch):
         with torch.no_grad():
-            pnotree_x, pnotree_y = batch
+            pnotree_x, pnotree_y = batch[: 2]
+            features = {}
+            if len(self.feature_stores) > 0:
+                shifts = torch.zeros(pnotree_x.size(0), dtype=torch.long)
+                features = self._cached_features(1, batch[-1], shifts)
             with self.autocast:
-                loss_dict = self.model.get_loss_dict(pnotree_x, pnotree_y)
+                loss_dict = self.model.get_loss_dict(pnotree_x, pnotree_y, **features)
         return loss_dict
 
 
+def build_feature_stores(model, train_dl, val_dl, params):
+    """
+    Open the enabled feature stores of the train and val sets, (re)computed if stale.
+    Return a list of (train_store, val_store).
+    """
+    fingerprint = file_fingerprint(PT_PNOTREE_PATH)
+    store_clses = []
+    if params.latent_cache:
+        store_clses.append(("latent", LatentStore))
+    if params.summary_cache:
+        store_clses.append(("summary", SummaryStore))
+    return [
+        tuple(
+            store_cls(join(FEATURE_CACHE_DIR, name, split)).open_or_build(
+                model, dl.dataset.dataset, fingerprint, params.batch_size,
+                params.num_workers
+            ) for split, dl in [("train", train_dl), ("valid", val_dl)]
+        ) for name, store_cls in store_clses
+    ]
+
+
 def train(params, output_dir=None):
     device = "cuda" if torch.cuda.is_available() else "cpu"
     model = Diffpro(params, pt_pnotree_model_path=PT_PNOTREE_PATH).to(device)
     optimizer = torch.optim.Adam(model.parameters(), lr=params.learning_rate)
     train_dl, val_dl = get_train_val_dataloaders(params.batch_size, params)
+    feature_stores = build_feature_stores(model, train_dl, val_dl, params)
     if output_dir is not None:
         os.makedirs(f"{output_dir}", exist_ok=True)
         output_dir = f"{output_dir}/{datetime.now().strftime('%m-%d_%H%M%S')}"
     else:
         output_dir = f"result/{datetime.now().strftime('%m-%d_%H%M%S')}"
-    learner = DiffproLearner(output_dir, model, train_dl, val_dl, optimizer, params)
+    learner = DiffproLearner(
+        output_dir, model, train_dl, val_dl, optimizer, params, feature_stores
+    )
     learner.train(max_epoch=params.max_epoch)
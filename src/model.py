@@ -2,6 +2,7 @@ from dl_modules import PianoTreeEncoder, PianoTreeDecoder, NaiveNN
 import torch
 import torch.nn as nn
 from utils import *
+import numpy as np
 
 
 class Diffpro(nn.Module):
@@ -21,6 +22,10 @@ class Diffpro(nn.Module):
             self.pnotree_dec = PianoTreeDecoder(
                 self.device, max_simu_note=max_simu_note
             )
+        self.pnotree_enc.pack_free = params.enc_pack_free
+        self.pnotree_dec.pack_free = params.dec_pack_free
+        self.pnotree_dec.early_exit = params.dec_early_exit
+        self.pnotree_dec.cell_loops = params.dec_cell_loops
         self.naive_nn = NaiveNN()
         self._disable_grads_for_enc_dec()
 
@@ -60,26 +65,39 @@ class Diffpro(nn.Module):
             "beta": self.params.beta
         }
 
-    def forward(self, pnotree_x, pnotree_y, tfr1, tfr2):
+    def forward(
+        self, pnotree_x, pnotree_y, tfr1, tfr2, dist_x=None, y_summarized=None
+    ):
         # FIXME: teacher-forcing is not needed here?
-        dist_x, emb_x, _ = self.pnotree_enc(pnotree_x)
+        # dist_x: the encoder's distribution of pnotree_x, if cached
+        # y_summarized: the decoder's summary of pnotree_y, if cached
+        if dist_x is None:
+            dist_x, emb_x, _ = self.pnotree_enc(pnotree_x)
 
         z_x = dist_x.rsample()
 
         z = self.naive_nn(z_x)
 
         # teaching force data
-        embedded_pnotree, pnotree_lgths = self.pnotree_dec.emb_x(pnotree_y)
+        if y_summarized is not None and tfr2 == 0:
+            # embedded notes are only needed for note-level teacher forcing
+            embedded_pnotree, pnotree_lgths = None, None
+        else:
+            embedded_pnotree, pnotree_lgths = self.pnotree_dec.emb_x(pnotree_y)
 
         # pianotree decoder
         recon_pitch, recon_dur = self.pnotree_dec(
-            z, False, embedded_pnotree, pnotree_lgths, tfr1, tfr2
+            z, False, embedded_pnotree, pnotree_lgths, tfr1, tfr2, y_summarized
         )
 
         return (recon_pitch, recon_dur, dist_x)
 
-    def get_loss_dict(self, pnotree_x, pnotree_y, tfr1=0, tfr2=0):
-        recon_pitch, recon_dur, dist_x = self.forward(pnotree_x, pnotree_y, tfr1, tfr2)
+    def get_loss_dict(
+        self, pnotree_x, pnotree_y, tfr1=0, tfr2=0, dist_x=None, y_summarized=None
+    ):
+        recon_pitch, recon_dur, dist_x = self.forward(
+            pnotree_x, pnotree_y, tfr1, tfr2, dist_x, y_summarized
+        )
 
         return self.loss_function(pnotree_y, recon_pitch, recon_dur, dist_x)
 
@@ -104,3 +122,32 @@ class Diffpro(nn.Module):
             recon_pitch, recon_dur = self.pnotree_dec(z, True, None, None, 0, 0)
 
             return self.output_to_numpy(recon_pitch, recon_dur)
+
+    def infer_samples(self, pnotree_x, num_samples, seed=None, max_batch=256):
+        """
+        num_samples alternative decodings of every segment of pnotree_x. pnotree_x is
+        encoded once, num_samples latents are drawn from each segment's dist_x, and
+        the num_samples * segments latents are decoded in batches of at most
+        max_batch, keeping only est_x of each batch.
+        Returns est_x: (num_samples, segments, 32, max_simu_note - 1, 6)
+        """
+        with torch.no_grad():
+            dist_x, _, _ = self.pnotree_enc(pnotree_x)
+            mu, std = dist_x.mean, dist_x.stddev
+            generator = torch.Generator(device=mu.device)
+            if seed is None:
+                generator.seed()
+            else:
+                generator.manual_seed(seed)
+            eps = torch.randn(
+                (num_samples, *mu.shape), generator=generator, device=mu.device
+            )
+            z_x = (mu + eps * std).view(-1, mu.size(-1))
+
+            est_x = []
+            for z_x_batch in z_x.split(max_batch):
+                z = self.naive_nn(z_x_batch)
+                recon_pitch, recon_dur = self.pnotree_dec(z, True, None, None, 0, 0)
+                est_x.append(self.output_to_numpy(recon_pitch, recon_dur)[0])
+            est_x = np.concatenate(est_x)
+            return est_x.reshape(num_samples, len(pnotree_x), *est_x.shape[1 :])
@@ -24,13 +24,45 @@ params = AttrDict(
     learning_rate=1e-4,
     max_grad_norm=1e5,
     fp16=False,
+    # teacher-forcing ratios of the decoder's time and note loops in training;
+    # both 1 runs the decoder fully in parallel (teacher_forced_decoder)
+    tfr1=0,
+    tfr2=0,
 
     # Data params
+    # "npz": per-song npz files; "compiled": segment_store.py;
+    # "stream": segment_shards.py
+    data_backend="npz",
+    lazy_songs=True,  # open songs on first access, sized by the corpus index (npz)
+    song_cache_bytes=2 * 1024**3,  # LRU budget of lazily opened songs, per worker
+    shared_cache=False,  # share converted segments across workers (npz backend)
     num_workers=4,
     pin_memory=True,
+    bucket_sampler=False,  # batch training segments of similar polyphony
+    num_buckets=8,
+    # random pitch shift of training pairs, batched:
+    # "device": on the training device after transfer; "worker": in collate_fn; None
+    pitch_shift_aug="device",
+
+    # cache the frozen encoder's mu/std of every segment and shift (feature_cache.py)
+    latent_cache=False,
+    # cache the frozen decoder's teacher-forcing summary of every segment and shift
+    summary_cache=False,
 
     # Model params
     beta=0.1,
+    # run the note-level GRUs on padded notes instead of packed sequences, which
+    # keeps lengths on the device (dl_modules/masked_gru.py)
+    enc_pack_free=False,
+    dec_pack_free=False,
+    # opt-in: stop decoding the notes of a step at inference once every row emits
+    # eos. Faster, but est_x after each step's first eos is then eos instead of the
+    # notes the padded decoder emits there, which estx_to_midi_file writes
+    dec_early_exit=False,
+    # opt-in: run the note loops at inference with GRU cells and precomputed input
+    # projections. Faster; the logits differ from nn.GRU's by float rounding
+    # (about 1e-7), which could flip a tied argmax, so est_x is not guaranteed equal
+    dec_cell_loops=False,
     weights=(1, 0.5),
 
     # unconditional sample len
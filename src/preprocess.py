@@ -0,0 +1,48 @@
+"""
+Offline preprocessing of the dataset.
+Usage: python preprocess.py <step>
+"""
+from argparse import ArgumentParser
+from tqdm import tqdm
+from dataset import convert_song_to_compact, read_corpus_index
+from segment_store import compile_train_and_valid_stores
+from segment_shards import write_train_and_valid_shards
+from dirs import *
+import os
+
+
+def run_compact(args):
+    """convert every song under DATA_DIR to the pickle-free compact format"""
+    for song_fn in tqdm(sorted(os.listdir(DATA_DIR)), desc="Converting"):
+        convert_song_to_compact(song_fn)
+
+
+def run_compile(args):
+    """compile the train/valid split into memory-mapped segment stores"""
+    compile_train_and_valid_stores()
+
+
+def run_shard(args):
+    """split the compiled train/valid stores into shards for streaming"""
+    write_train_and_valid_shards()
+
+
+def run_index(args):
+    """scan new or modified songs under DATA_DIR into the corpus index"""
+    read_corpus_index(check_mtime=True)
+
+
+STEPS = {
+    "index": run_index,
+    "compact": run_compact,
+    "compile": run_compile,
+    "shard": run_shard,
+}
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='offline preprocessing of the dataset')
+    subparsers = parser.add_subparsers(required=True)
+    for name, step in STEPS.items():
+        subparsers.add_parser(name, help=step.__doc__).set_defaults(func=step)
+    args = parser.parse_args()
+    args.func(args)
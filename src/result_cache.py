@@ -0,0 +1,182 @@
+"""
+Deterministic inference of pianotree segments, deduplicated and cached on disk.
+
+With is_sampling=False, est_x of a segment is a pure function of the (32, 20, 6)
+input, the model weights and the DECODING_PARAMS. `DedupInference` hashes the
+segments of a batch, infers each distinct segment once and expands the results
+back; with an
+`InferenceResultCache`, results persist across runs in an sqlite file:
+    results(model, segment, est_x, last_used)
+keyed by the sha1 of the checkpoint (`feature_cache.file_fingerprint`) together with
+the params that change how it decodes (`model_fingerprint`), and of the segment,
+holding at most max_entries rows, the least recently used evicted first.
+"""
+from feature_cache import file_fingerprint
+import hashlib
+import json
+import sqlite3
+import numpy as np
+import torch
+
+# est_x of one segment: pitch and duration indices, all below 256
+EST_X_SHAPE = (32, 19, 6)
+# params selecting the encoder and decoder code paths at inference: dec_early_exit
+# changes est_x after eos, the others may flip argmaxes by float rounding
+DECODING_PARAMS = ["enc_pack_free", "dec_pack_free", "dec_early_exit", "dec_cell_loops"]
+
+
+def model_fingerprint(model_dir, params):
+    """
+    sha1 of the checkpoint `Diffpro.load_trained(model_dir, params)` loads and of
+    the DECODING_PARAMS of params
+    """
+    decoding = {name: params[name] for name in DECODING_PARAMS}
+    sha1 = hashlib.sha1(file_fingerprint(f"{model_dir}/weights.pt").encode())
+    sha1.update(json.dumps(decoding, sort_keys=True).encode())
+    return sha1.hexdigest()
+
+
+def segment_hashes(pnotree_x):
+    """sha1 hex digests of the segments of pnotree_x (n, 32, 20, 6), by value"""
+    if isinstance(pnotree_x, torch.Tensor):
+        pnotree_x = pnotree_x.cpu().numpy()
+    segs = np.ascontiguousarray(pnotree_x, dtype=np.int64).reshape(len(pnotree_x), -1)
+    return [hashlib.sha1(seg.tobytes()).hexdigest() for seg in segs]
+
+
+class InferenceResultCache:
+    """
+    est_x of segments under one model fingerprint, in the sqlite file db_fpath.
+    Counters are of the current process, see `stats`.
+    """
+
+    def __init__(self, db_fpath, fingerprint, max_entries=100000):
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(db_fpath)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results (model TEXT, segment TEXT, "
+            "est_x BLOB, last_used INTEGER, PRIMARY KEY (model, segment))"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)"
+        )
+        self.db.commit()
+        # recency of an entry: a counter carried over from earlier runs
+        self.clock = self.db.execute("SELECT MAX(last_used) FROM results").fetchone()[0]
+        self.clock = self.clock or 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, keys):
+        """est_x of the cached segments among keys, a dict key -> (32, 19, 6)"""
+        found = {}
+        for start in range(0, len(keys), 500):
+            part = keys[start : start + 500]
+            rows = self.db.execute(
+                "SELECT segment, est_x FROM results WHERE model = ? AND segment IN "
+                f"({', '.join('?' * len(part))})",
+                [self.fingerprint, *part],
+            )
+            for key, est_x in rows:
+                found[key] = np.frombuffer(est_x, dtype=np.uint8).reshape(EST_X_SHAPE)
+        self.clock += 1
+        self.db.executemany(
+            "UPDATE results SET last_used = ? WHERE model = ? AND segment = ?",
+            [(self.clock, self.fingerprint, key) for key in found],
+        )
+        self.db.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put(self, keys, est_x):
+        """Store est_x (n, 32, 19, 6) of keys, then evict down to max_entries"""
+        self.clock += 1
+        est_x = np.asarray(est_x).astype(np.uint8)
+        self.db.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+            [
+                (self.fingerprint, key, x.tobytes(), self.clock)
+                for key, x in zip(keys, est_x)
+            ],
+        )
+        num_entries = self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if num_entries > self.max_entries:
+            cursor = self.db.execute(
+                "DELETE FROM results WHERE rowid IN (SELECT rowid FROM results "
+                "ORDER BY last_used LIMIT ?)",
+                (num_entries - self.max_entries, ),
+            )
+            self.evictions += cursor.rowcount
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else None,
+            "evictions": self.evictions,
+            "entries": len(self),
+        }
+
+
+class DedupInference:
+    """
+    est_x of `model.infer(pnotree_x)` (deterministic), inferring each distinct
+    segment of a batch once, and none that cache holds.
+    """
+
+    def __init__(self, model, cache=None):
+        self.model = model
+        self.cache = cache
+        self.segments = 0
+        self.unique = 0
+        self.inferred = 0
+
+    def infer(self, pnotree_x):
+        """
+        est_x (n, 32, 19, 6) of pnotree_x (n, 32, 20, 6). The segments to infer
+        run in one batch on pnotree_x's device.
+        """
+        keys = segment_hashes(pnotree_x)
+        # first occurrence of every distinct segment
+        firsts = {}
+        for i, key in enumerate(keys):
+            firsts.setdefault(key, i)
+        found = self.cache.get(list(firsts)) if self.cache is not None else {}
+        missing = [key for key in firsts if key not in found]
+        if len(missing) > 0:
+            inds = [firsts[key] for key in missing]
+            inds = torch.tensor(inds, device=pnotree_x.device)
+            est_x, _, _ = self.model.infer(pnotree_x[inds], is_sampling=False)
+            found.update(zip(missing, est_x))
+            if self.cache is not None:
+                self.cache.put(missing, est_x)
+        self.segments += len(keys)
+        self.unique += len(firsts)
+        self.inferred += len(missing)
+        if len(keys) == 0:
+            return np.zeros((0, *EST_X_SHAPE), dtype=np.int64)
+        return np.stack([found[key] for key in keys]).astype(np.int64)
+
+    def stats(self):
+        stats = {
+            "segments": self.segments,
+            "unique": self.unique,
+            "inferred": self.inferred,
+            "dedup_rate":
+                1 - self.unique / self.segments if self.segments > 0 else None,
+        }
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
@@ -0,0 +1,45 @@
+from torch.utils.data import Sampler
+import numpy as np
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler grouping segments of similar density.
+
+    Segments are sorted by (max_polyphony_x, max_polyphony_y, note_count_x,
+    note_count_y) and cut into `num_buckets` equal-size buckets. Every batch comes
+    from one bucket, so the note sequences packed by the encoder and decoder GRUs
+    have similar lengths. Shuffling happens within each bucket and over the order
+    of all batches, with a new permutation every epoch.
+    """
+    def __init__(
+        self, seg_stats, batch_size, num_buckets=8, drop_last=False, seed=0
+    ):
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+        note_count_x, max_poly_x, note_count_y, max_poly_y = seg_stats.T
+        order = np.lexsort((note_count_y, note_count_x, max_poly_y, max_poly_x))
+        self.buckets = np.array_split(order, num_buckets)
+
+    def _num_batches(self, bucket):
+        if self.drop_last:
+            return len(bucket) // self.batch_size
+        return -(-len(bucket) // self.batch_size)
+
+    def __len__(self):
+        return sum(self._num_batches(bucket) for bucket in self.buckets)
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+
+        batches = []
+        for bucket in self.buckets:
+            bucket = rng.permutation(bucket)
+            for i in range(self._num_batches(bucket)):
+                batches.append(bucket[i * self.batch_size : (i + 1) * self.batch_size])
+        for i in rng.permutation(len(batches)):
+            yield batches[i].tolist()
@@ -0,0 +1,214 @@
+"""
+Sharded pianotree segments for streaming.
+
+`write_segment_shards` splits a compiled segment store (see segment_store.py) into
+shard files of `shard_size` segments, in a random global order:
+    shard-00000.npz, ...: pnotree_x, pnotree_y, (shard_size, 32, 20, 6) int16
+    shards.npz: shard_fns, shard_lengths
+`PianoOrchStreamDataset` streams the shards sequentially, so training reads large
+files front to back instead of opening songs at random.
+Run `python preprocess.py shard` after `python preprocess.py compile`.
+"""
+from torch.utils.data import IterableDataset, get_worker_info
+from tqdm import tqdm
+from segment_store import PianoOrchSegmentDataset
+from threading import Event, Thread
+from queue import Full, Queue
+from dirs import *
+import os
+import numpy as np
+import torch.distributed as dist
+
+
+def write_segment_shards(store_dir, shard_dir, shard_size=8192, seed=0):
+    store = PianoOrchSegmentDataset(store_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+    # segments of a song are spread over all shards
+    order = np.random.default_rng(seed).permutation(len(store))
+    shard_fns = []
+    shard_lengths = []
+    for s in tqdm(range(0, len(order), shard_size), desc=f"Sharding {store_dir}"):
+        indices = np.sort(order[s : s + shard_size])
+        shard_fn = f"shard-{len(shard_fns):05d}.npz"
+        np.savez(
+            os.path.join(shard_dir, shard_fn),
+            pnotree_x=store.pnotree_x[indices],
+            pnotree_y=store.pnotree_y[indices],
+        )
+        shard_fns.append(shard_fn)
+        shard_lengths.append(len(indices))
+    np.savez(
+        os.path.join(shard_dir, "shards.npz"),
+        shard_fns=np.array(shard_fns, dtype=str),
+        shard_lengths=np.array(shard_lengths, dtype=np.int64),
+    )
+
+
+def write_train_and_valid_shards(shard_size=8192):
+    for split in ["train", "valid"]:
+        write_segment_shards(
+            os.path.join(COMPILED_DIR, split), os.path.join(SHARD_DIR, split),
+            shard_size
+        )
+
+
+class PianoOrchStreamDataset(IterableDataset):
+    """
+    Iterates (pianotree_x, pianotree_y) over segment shards.
+
+    Every epoch permutes the shard order with the same seed in all ranks and
+    workers, and cuts the segments in that order into equal contiguous ranges, one
+    per (rank, DataLoader worker) reader, so all ranks yield the same number of
+    segments (and of batches, with equal num_workers) and DDP stays in step. The
+    remainder of fewer than world_size * num_workers segments is dropped;
+    num_workers must be that of the DataLoader for `__len__` to count without it.
+    Each worker reads up to `read_ahead` shards in a background thread, which stops
+    when the epoch's iterator is closed early, and draws items from a shuffle buffer
+    of `buffer_size` segments.
+    The epoch counter advances on every `__iter__`, which keeps workers and ranks
+    in step as long as DataLoader workers are persistent.
+    """
+    def __init__(
+        self,
+        shard_dir,
+        shuffle=True,
+        buffer_size=4096,
+        read_ahead=2,
+        seed=0,
+        num_workers=0,
+    ):
+        super(PianoOrchStreamDataset, self).__init__()
+        self.shard_dir = shard_dir
+        index = np.load(os.path.join(shard_dir, "shards.npz"))
+        self.shard_fns = index["shard_fns"]
+        self.shard_lengths = index["shard_lengths"]
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.read_ahead = read_ahead
+        self.seed = seed
+        self.num_workers = num_workers
+        self.epoch = 0
+
+        if dist.is_available() and dist.is_initialized():
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+        else:
+            self.rank, self.world_size = 0, 1
+
+    def __len__(self):
+        """Segments yielded to this rank per epoch, by all of its workers"""
+        num_workers = max(self.num_workers, 1)
+        num_readers = self.world_size * num_workers
+        return int(self.shard_lengths.sum()) // num_readers * num_workers
+
+    def _assigned_shards(self, epoch):
+        """
+        (shard_fn, start, end) slices of this reader's segment range, and its id
+        """
+        order = np.arange(len(self.shard_fns))
+        if self.shuffle:
+            order = np.random.default_rng((self.seed, epoch)).permutation(order)
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        reader_id = self.rank * num_workers + worker_id
+        num_readers = self.world_size * num_workers
+
+        offsets = np.concatenate([[0], np.cumsum(self.shard_lengths[order])])
+        quota = offsets[-1] // num_readers
+        lo, hi = reader_id * quota, (reader_id + 1) * quota
+        slices = []
+        for i, shard_no in enumerate(order):
+            start = max(lo, offsets[i]) - offsets[i]
+            end = min(hi, offsets[i + 1]) - offsets[i]
+            if start < end:
+                slices.append((self.shard_fns[shard_no], start, end))
+        return slices, reader_id
+
+    @staticmethod
+    def _put(queue, item, stop):
+        """queue.put(item) unless stop is set first, whether it was put"""
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _read_shards(self, slices, queue, stop):
+        error = None
+        try:
+            for shard_fn, start, end in slices:
+                with np.load(os.path.join(self.shard_dir, shard_fn)) as shard:
+                    pnotree_x = shard["pnotree_x"][start : end]
+                    pnotree_y = shard["pnotree_y"][start : end]
+                if not self._put(queue, (pnotree_x, pnotree_y), stop):
+                    return
+        except Exception as e:
+            error = e
+        finally:
+            # the end of the shards, or why reading stopped
+            self._put(queue, error, stop)
+
+    def _iter_shards(self, slices):
+        """
+        Yield the shard slices in order, reading ahead in a background thread, and
+        raise what the thread raised. Closing the generator stops the thread.
+        """
+        queue = Queue(maxsize=max(self.read_ahead, 1))
+        stop = Event()
+        reader = Thread(
+            target=self._read_shards, args=(slices, queue, stop), daemon=True
+        )
+        reader.start()
+        try:
+            while True:
+                shard = queue.get()
+                if isinstance(shard, Exception):
+                    raise shard
+                if shard is None:
+                    break
+                yield shard
+        finally:
+            stop.set()
+            reader.join()
+
+    def __iter__(self):
+        epoch = self.epoch
+        self.epoch += 1
+        slices, reader_id = self._assigned_shards(epoch)
+        rng = np.random.default_rng((self.seed, epoch, reader_id))
+
+        buffer = []
+        shards = self._iter_shards(slices)
+        try:
+            for pnotree_x, pnotree_y in shards:
+                for i in range(len(pnotree_x)):
+                    item = (pnotree_x[i], pnotree_y[i])
+                    if not self.shuffle:
+                        yield item
+                    elif len(buffer) < self.buffer_size:
+                        buffer.append(item)
+                    else:
+                        j = rng.integers(len(buffer))
+                        yield buffer[j]
+                        buffer[j] = item
+        finally:
+            # stops reading ahead when the epoch is cut short
+            shards.close()
+        for j in rng.permutation(len(buffer)):
+            yield buffer[j]
+
+    @classmethod
+    def load_train_and_valid_sets(cls, debug=False, num_workers=0):
+        assert not debug, "song names are not kept in shards"
+        return (
+            cls(os.path.join(SHARD_DIR, "train"), num_workers=num_workers),
+            cls(
+                os.path.join(SHARD_DIR, "valid"),
+                shuffle=False,
+                num_workers=num_workers
+            ),
+        )
@@ -0,0 +1,160 @@
+"""
+Precompiled PianoTree segment store.
+
+`compile_segment_store` converts every (x, y) segment of a list of songs once and
+writes them into two contiguous arrays on disk:
+    pnotree_x.npy, pnotree_y.npy: (num_segments, 32, 20, 6), int16
+    index.npz:
+        song_fns: song names
+        song_offsets: (num_songs + 1,), segments of the i-th song are
+            [song_offsets[i]: song_offsets[i + 1]]
+        db_pos: (num_segments,), the downbeat of each segment in its song
+Segments keep the order of `PianoOrchDataset`, so a global index means the same
+segment in both datasets.
+
+`PianoOrchSegmentDataset` serves the store by slicing memory-mapped arrays.
+Run `python preprocess.py compile` to build the stores of the train/valid split.
+"""
+from torch.utils.data import Dataset
+from tqdm import tqdm
+from dataset import DataSampleNpz, open_data_sample
+from utils import read_dict
+from dirs import *
+import hashlib
+import os
+import numpy as np
+
+STORE_DTYPE = np.int16
+# segments per read when scanning a store
+STATS_CHUNK = 4096
+
+
+def compile_segment_store(song_fns, store_dir):
+    os.makedirs(store_dir, exist_ok=True)
+    lgths = [DataSampleNpz.read_num_segments(song_fn) for song_fn in song_fns]
+    song_offsets = np.cumsum([0] + lgths).astype(np.int64)
+    num_segs = int(song_offsets[-1])
+
+    shape = (num_segs, 32, 20, 6)
+    pnotree_x = np.lib.format.open_memmap(
+        os.path.join(store_dir, "pnotree_x.npy"), "w+", STORE_DTYPE, shape
+    )
+    pnotree_y = np.lib.format.open_memmap(
+        os.path.join(store_dir, "pnotree_y.npy"), "w+", STORE_DTYPE, shape
+    )
+    db_pos = np.zeros(num_segs, dtype=np.int64)
+
+    for i, song_fn in enumerate(tqdm(song_fns, desc=f"Compiling {store_dir}")):
+        song = open_data_sample(song_fn)
+        s, e = song_offsets[i], song_offsets[i + 1]
+        assert len(song) == e - s
+        if len(song) == 0:
+            continue
+        pnotree_x[s : e], pnotree_y[s : e] = song.get_all_segs()
+        db_pos[s : e] = song.db_pos
+    pnotree_x.flush()
+    pnotree_y.flush()
+
+    # the index is written last: a store without it is incomplete
+    np.savez(
+        os.path.join(store_dir, "index.npz"),
+        song_fns=np.array(song_fns, dtype=str),
+        song_offsets=song_offsets,
+        db_pos=db_pos,
+    )
+
+
+def compile_train_and_valid_stores():
+    split = read_dict(os.path.join(TRAIN_SPLIT_DIR, "split_dict.pickle"))
+    compile_segment_store(split[0], os.path.join(COMPILED_DIR, "train"))
+    compile_segment_store(split[1], os.path.join(COMPILED_DIR, "valid"))
+
+
+class PianoOrchSegmentDataset(Dataset):
+    """
+    Same items as `PianoOrchDataset`, read from a compiled segment store.
+    Items are zero-copy slices of the memory-mapped store.
+    """
+    def __init__(self, store_dir, debug=False):
+        super(PianoOrchSegmentDataset, self).__init__()
+        self.store_dir = store_dir
+        index = np.load(os.path.join(store_dir, "index.npz"))
+        self.song_fns = index["song_fns"]
+        self.song_offsets = index["song_offsets"]
+        self.db_pos = index["db_pos"]
+        self.pnotree_x = np.load(
+            os.path.join(store_dir, "pnotree_x.npy"), mmap_mode="r"
+        )
+        self.pnotree_y = np.load(
+            os.path.join(store_dir, "pnotree_y.npy"), mmap_mode="r"
+        )
+        self.debug = debug
+
+    def __len__(self):
+        return len(self.pnotree_x)
+
+    def __getitem__(self, index):
+        if self.debug:
+            song_no = np.searchsorted(self.song_offsets, index, side="right") - 1
+            song_fn = str(self.song_fns[song_no])
+            return self.pnotree_x[index], self.pnotree_y[index], song_fn
+        else:
+            return self.pnotree_x[index], self.pnotree_y[index]
+
+    def seg_stats(self):
+        """
+        (len(self), 4) statistics of every segment, same columns as
+        `PianoOrchDataset.seg_stats`, counted on the stored pianotrees.
+        Computed from the store on first use and saved next to it.
+        """
+        fpath = os.path.join(self.store_dir, "seg_stats.npy")
+        if os.path.exists(fpath):
+            return np.load(fpath)
+        stats = np.zeros((len(self), 4), dtype=np.int64)
+        for s in range(0, len(self), STATS_CHUNK):
+            e = min(s + STATS_CHUNK, len(self))
+            for j, pnotree in enumerate((self.pnotree_x[s : e], self.pnotree_y[s : e])):
+                polyphony = (pnotree[:, :, :, 0] < 128).sum(axis=-1)
+                stats[s : e, 2 * j] = polyphony.sum(axis=-1)
+                stats[s : e, 2 * j + 1] = polyphony.max(axis=-1)
+        np.save(fpath, stats)
+        return stats
+
+    def fingerprint(self):
+        """
+        sha1 of the store's index (ordered songs and segments) and of the size and
+        modification time of its arrays
+        """
+        sha1 = hashlib.sha1()
+        with open(os.path.join(self.store_dir, "index.npz"), "rb") as f:
+            sha1.update(f.read())
+        for fn in ["pnotree_x.npy", "pnotree_y.npy"]:
+            stat = os.stat(os.path.join(self.store_dir, fn))
+            sha1.update(f"{fn}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+        return sha1.hexdigest()
+
+    def __getitems__(self, indices):
+        """Fetch a whole sampler batch with one read per array, used by DataLoader"""
+        indices = np.asarray(indices, dtype=np.int64)
+        # sorted reads are sequential on disk; the batch order is restored after
+        order = np.argsort(indices)
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        pnotree_x = self.pnotree_x[indices[order]][inverse]
+        pnotree_y = self.pnotree_y[indices[order]][inverse]
+        if self.debug:
+            song_nos = np.searchsorted(self.song_offsets, indices, side="right") - 1
+            return [
+                (x, y, str(self.song_fns[song_no]))
+                for x, y, song_no in zip(pnotree_x, pnotree_y, song_nos)
+            ]
+        else:
+            return list(zip(pnotree_x, pnotree_y))
+
+    @classmethod
+    def load_train_and_valid_sets(cls, debug=False):
+        return (
+            cls(os.path.join(COMPILED_DIR, "train"), debug),
+            cls(os.path.join(COMPILED_DIR, "valid"), debug),
+        )
+
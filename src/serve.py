@@ -0,0 +1,282 @@
+"""
+A long-running local inference service for a trained Diffpro model.
+
+Segments of concurrent requests are coalesced into batches of at most max_batch
+segments, waiting at most max_wait seconds for a batch to fill, and the results are
+scattered back to each request. Runs on CPU-only hosts.
+
+Usage: python serve.py --model_dir <dir> [--port 8000]
+    POST /infer {"pnotree": (n, 32, 20, 6) nested list} or {"song_fn": song_fn}
+        -> {"est_x": (n, 32, 19, 6) nested list}, the decoded notes after sos
+    GET /metrics -> queue depth, batch size and latency histograms
+"""
+from argparse import ArgumentParser
+from bisect import bisect_left
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import threading
+import time
+import numpy as np
+import torch
+from dataset import open_data_sample
+from model import Diffpro
+from params import params
+
+LATENCY_BOUNDS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+# pianotree indices, see utils.nmats_to_pianotree_repr
+PITCH_SOS = 128
+PITCH_PAD = 130
+DUR_PAD = 2
+
+
+def check_song_fn(song_fn):
+    """song_fn must name a song directory of DATA_DIR, not a path"""
+    if not isinstance(song_fn, str) or song_fn in ("", ".", ".."):
+        raise ValueError(f"invalid song_fn {song_fn!r}")
+    if any(sep in song_fn for sep in ["/", "\\", os.sep, ".."]):
+        raise ValueError(f"song_fn must not be a path, got {song_fn!r}")
+
+
+def check_pnotree(pnotree):
+    """
+    pnotree must be (n, 32, 20, 6) pianotree indices: pitches in [0, PITCH_PAD],
+    duration bits in {0, 1}, or DUR_PAD on the sos, eos and pad rows.
+    """
+    if pnotree.dim() != 4 or pnotree.shape[1 :] != (32, 20, 6):
+        raise ValueError(f"expected (n, 32, 20, 6), got {tuple(pnotree.shape)}")
+    pitch = pnotree[..., 0]
+    durs = pnotree[..., 1 :]
+    if ((pitch < 0) | (pitch > PITCH_PAD)).any():
+        raise ValueError(f"pitches must be in [0, {PITCH_PAD}]")
+    if ((durs < 0) | (durs > DUR_PAD)).any():
+        raise ValueError(f"duration bits must be in [0, {DUR_PAD}]")
+    if (durs[pitch < PITCH_SOS] == DUR_PAD).any():
+        raise ValueError("duration bits of notes must be 0 or 1")
+
+
+class Histogram:
+    """
+    Counts of observed values in fixed buckets: counts[i] counts values <= bounds[i]
+    (and > bounds[i - 1]), the last bucket values above all bounds.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.num = 0
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect_left(self.bounds, value)] += 1
+            self.num += 1
+            self.total += value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "bounds": self.bounds,
+                "counts": list(self.counts),
+                "count": self.num,
+                "mean": self.total / self.num if self.num > 0 else None,
+            }
+
+
+class _Request:
+    """The segments of one request and their results, filled batch by batch"""
+
+    def __init__(self, pnotree):
+        self.pnotree = pnotree
+        self.est_x = None
+        self.remaining = len(pnotree)
+        self.error = None
+        self.done = threading.Event()
+        self.start = time.perf_counter()
+
+
+class DynamicBatcher:
+    """
+    Runs `model.infer` on the segments of concurrent `submit` calls in shared
+    batches, on a worker thread. A batch is formed once max_batch segments are
+    pending or max_wait seconds after the first of them arrived; requests longer
+    than max_batch are split over several batches.
+    """
+
+    def __init__(self, model, device, max_batch=64, max_wait=0.01):
+        self.model = model
+        self.device = device
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        # (request, start, end) ranges of segments not yet batched
+        self.pending = deque()
+        self.num_pending = 0
+        self.cond = threading.Condition()
+        self.closed = False
+        self.metrics = {
+            "queue_depth": Histogram([2**i for i in range(12)]),
+            "batch_size": Histogram([2**i for i in range(max_batch.bit_length())]),
+            "latency": Histogram(LATENCY_BOUNDS),
+        }
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, pnotree):
+        """
+        Infer est_x (n, 32, 19, 6) of pnotree (n, 32, 20, 6), blocking until all of
+        its segments are decoded.
+        """
+        if len(pnotree) == 0:
+            return np.zeros((0, 32, 19, 6), dtype=np.int64)
+        request = _Request(pnotree)
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("the batcher is closed")
+            self.pending.append((request, 0, len(pnotree)))
+            self.num_pending += len(pnotree)
+            self.cond.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        self.metrics["latency"].observe(time.perf_counter() - request.start)
+        return request.est_x
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.worker.join()
+
+    def stats(self):
+        return {k: v.snapshot() for k, v in self.metrics.items()}
+
+    def _next_batch(self):
+        """Pop up to max_batch pending segments, None once closed and drained"""
+        with self.cond:
+            while self.num_pending == 0 and not self.closed:
+                self.cond.wait()
+            if self.num_pending == 0:
+                return None
+            deadline = time.perf_counter() + self.max_wait
+            while self.num_pending < self.max_batch and not self.closed:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                self.cond.wait(timeout)
+            self.metrics["queue_depth"].observe(self.num_pending)
+
+            batch = []
+            room = self.max_batch
+            while room > 0 and len(self.pending) > 0:
+                request, start, end = self.pending.popleft()
+                if end - start > room:
+                    self.pending.appendleft((request, start + room, end))
+                    end = start + room
+                batch.append((request, start, end))
+                room -= end - start
+            self.num_pending -= self.max_batch - room
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            pnotree = torch.cat([request.pnotree[s : e] for request, s, e in batch])
+            self.metrics["batch_size"].observe(len(pnotree))
+            try:
+                est_x, _, _ = self.model.infer(pnotree.to(self.device))
+            except Exception as e:
+                for request, _, _ in batch:
+                    request.error = e
+                    request.done.set()
+                continue
+
+            offset = 0
+            for request, start, end in batch:
+                if request.est_x is None:
+                    request.est_x = np.empty(
+                        (len(request.pnotree), *est_x.shape[1 :]), dtype=est_x.dtype
+                    )
+                request.est_x[start : end] = est_x[offset : offset + end - start]
+                offset += end - start
+                request.remaining -= end - start
+                if request.remaining == 0:
+                    request.done.set()
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    batcher = None  # DynamicBatcher, set by serve()
+
+    def _send_json(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        self._send_json(200, self.batcher.stats())
+
+    def do_POST(self):
+        if self.path != "/infer":
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            query = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if "song_fn" in query:
+                check_song_fn(query["song_fn"])
+                pnotree, _ = open_data_sample(query["song_fn"]).get_whole_song_data()
+            else:
+                pnotree = torch.tensor(query["pnotree"], dtype=torch.long)
+                if pnotree.dim() == 3:
+                    pnotree = pnotree.unsqueeze(0)
+                check_pnotree(pnotree)
+        except Exception as e:
+            self._send_json(400, {"error": repr(e)})
+            return
+        try:
+            est_x = self.batcher.submit(pnotree)
+        except Exception as e:
+            self._send_json(500, {"error": repr(e)})
+            return
+        self._send_json(200, {"est_x": est_x.tolist()})
+
+
+def serve(model_dir, host, port, max_batch, max_wait):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = Diffpro.load_trained(model_dir, params).to(device).eval()
+    InferenceHandler.batcher = DynamicBatcher(model, device, max_batch, max_wait)
+    server = ThreadingHTTPServer((host, port), InferenceHandler)
+    print(f"serving {model_dir} on http://{host}:{port} ({device})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        InferenceHandler.batcher.close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='serve a Diffpro model over HTTP')
+    parser.add_argument(
+        "--model_dir", help='directory in which trained model checkpoints are stored'
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch", type=int, default=64)
+    parser.add_argument(
+        "--max_wait_ms", type=float, default=10, help='wait for a batch to fill'
+    )
+    parser.add_argument("--num_threads", type=int, help='torch intra-op threads')
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    serve(args.model_dir, args.host, args.port, args.max_batch, args.max_wait_ms / 1e3)
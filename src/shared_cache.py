@@ -0,0 +1,91 @@
+import os
+import numpy as np
+import torch
+
+# shape of a pianotree segment
+SEG_SHAPE = (32, 20, 6)
+# share of the free /dev/shm a cache may take, the rest is left to DataLoader
+# workers passing batches
+SHM_MAX_FRACTION = 0.8
+
+
+def shm_free_bytes():
+    """Free bytes of /dev/shm, None where it cannot be queried"""
+    try:
+        stat = os.statvfs("/dev/shm")
+    except OSError:
+        return None
+    return stat.f_bavail * stat.f_frsize
+
+
+class SharedSegmentCache:
+    """
+    Pianotree segments shared by all DataLoader workers.
+
+    Segment i of a dataset (i.e., the segment at a (song, downbeat) pair) has one
+    slot for each side (0: orchestra x, 1: piano y). Storage lives in shared memory
+    and is created in the main process, so every worker reads what another worker
+    has filled, and the cache survives worker restarts across epochs.
+    Memory: num_segs * 2 * 32 * 20 * 6 * 2 bytes (+ 2 flag bytes), all allocated up
+    front, see `create`.
+
+    A slot's data is written before its `filled` flag, but there is no memory
+    barrier between the two writes: a reader in another process relies on the
+    stores becoming visible in program order, which holds on x86 but is not
+    guaranteed on weakly ordered CPUs.
+    """
+    def __init__(self, num_segs):
+        self.pnotree = torch.empty((num_segs, 2, *SEG_SHAPE),
+                                   dtype=torch.int16).share_memory_()
+        self.filled = torch.zeros((num_segs, 2), dtype=torch.bool).share_memory_()
+
+        # counters of the current process
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def nbytes(num_segs):
+        return num_segs * 2 * (2 * int(np.prod(SEG_SHAPE)) + 1)
+
+    @classmethod
+    def create(cls, num_segs):
+        """
+        A cache of num_segs segments, or None (printing why) if it would take more
+        than SHM_MAX_FRACTION of the free /dev/shm
+        """
+        free = shm_free_bytes()
+        nbytes = cls.nbytes(num_segs)
+        if free is not None and nbytes > SHM_MAX_FRACTION * free:
+            print(
+                f"shared segment cache disabled: {nbytes / 2**30:.2f}GiB for "
+                f"{num_segs} segments, {free / 2**30:.2f}GiB free in /dev/shm"
+            )
+            return None
+        return cls(num_segs)
+
+    def __len__(self):
+        return len(self.filled)
+
+    def get(self, index):
+        """Return (pianotree_x, pianotree_y) of segment `index`, or None if missing"""
+        if not self.filled[index].all():
+            self.misses += 1
+            return None
+        self.hits += 1
+        pnotree = self.pnotree[index].numpy()
+        return pnotree[0], pnotree[1]
+
+    def put(self, index, pnotree_x, pnotree_y):
+        # data is written before the flags, so readers never see a partial slot.
+        # Concurrent writers of one slot write identical data.
+        self.pnotree[index, 0] = torch.from_numpy(pnotree_x)
+        self.pnotree[index, 1] = torch.from_numpy(pnotree_y)
+        self.filled[index] = True
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "filled": int(self.filled.all(dim=1).sum()),
+            "num_segs": len(self),
+        }
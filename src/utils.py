@@ -2,10 +2,12 @@ from dirs import *
 import numpy as np
 import pickle
 import os
-import pretty_midi as pm
+import mido
+import struct
 import torch
 from dl_modules import PianoTreeEncoder, PianoTreeDecoder
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from torch.distributions import Normal, kl_divergence
 
 
@@ -72,6 +74,11 @@ def kl_with_normal(dist):
     return kl
 
 
+# DUR_BITS[d] is the 5-bit binary repr of (d - 1), e.g., DUR_BITS[4] = [0, 0, 0, 1, 1].
+# Row 0 follows np.binary_repr(-1, width=5), i.e., all ones.
+DUR_BITS = (np.arange(-1, 32)[:, None] >> np.arange(4, -1, -1)) & 1
+
+
 def nmat_to_pianotree_repr(
     nmat,
     n_step=32,
@@ -86,28 +93,80 @@ def nmat_to_pianotree_repr(
     Convert the input note matrix to pianotree representation.
     Input: (N, 3), 3 for onset, pitch, duration. o and d are in time steps.
     """
-
-    pnotree = np.ones((n_step, max_note_count, 6), dtype=np.int64) * dur_pad_ind
-    pnotree[:, :, 0] = pitch_pad_ind
-    pnotree[:, 0, 0] = pitch_sos_ind
-
-    cur_idx = np.ones(n_step, dtype=np.int64)
-    for o, p, d in nmat:
-        pnotree[o, cur_idx[o], 0] = p - min_pitch
-
-        # e.g., d = 4 -> bin_str = '00011'
-        d = min(d, 32)
-        bin_str = np.binary_repr(int(d) - 1, width=5)
-        pnotree[o, cur_idx[o],
-                1 :] = np.fromstring(" ".join(list(bin_str)), dtype=np.int64, sep=" ")
-
-        # FIXME: when more than `max_note_count` notes are played in one step
-        if cur_idx[o] < max_note_count - 1:
-            cur_idx[o] += 1
-        else:
-            print(f"more than max_note_count {max_note_count} occur!")
-
-    pnotree[np.arange(0, n_step), cur_idx, 0] = pitch_eos_ind
+    return nmats_to_pianotree_repr(
+        nmat,
+        np.array([0, len(nmat)]),
+        n_step,
+        max_note_count,
+        dur_pad_ind,
+        min_pitch,
+        pitch_sos_ind,
+        pitch_eos_ind,
+        pitch_pad_ind,
+    )[0]
+
+
+def nmats_to_pianotree_repr(
+    nmats,
+    offsets=None,
+    n_step=32,
+    max_note_count=20,
+    dur_pad_ind=2,
+    min_pitch=0,
+    pitch_sos_ind=128,
+    pitch_eos_ind=129,
+    pitch_pad_ind=130,
+):
+    """
+    Convert many note matrices to pianotree representation at once.
+    Input: either a list of (N_i, 3) note matrices, or a concatenated (sum(N_i), 3)
+        note matrix together with `offsets` ((S + 1,), offsets[i] is the first row
+        of the i-th segment).
+    Output: (S, n_step, max_note_count, 6)
+
+    Notes are placed in their input order within each step. When more than
+    `max_note_count - 2` notes share a step, the last slot keeps the last of them
+    and is then overwritten by <eos> in the pitch column.
+    """
+    if offsets is None:
+        offsets = np.cumsum([0] + [len(nmat) for nmat in nmats])
+        nmats = [np.reshape(nmat, (-1, 3)) for nmat in nmats]
+        nmats = np.concatenate(nmats) if len(nmats) > 0 else np.zeros((0, 3))
+    nmat = np.reshape(np.asarray(nmats, dtype=np.int64), (-1, 3))
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n_seg = len(offsets) - 1
+
+    pnotree = np.full((n_seg, n_step, max_note_count, 6), dur_pad_ind, dtype=np.int64)
+    pnotree[:, :, :, 0] = pitch_pad_ind
+    pnotree[:, :, 0, 0] = pitch_sos_ind
+
+    # each note falls into a cell, i.e., a (segment, step) pair
+    seg = np.repeat(np.arange(n_seg), np.diff(offsets))
+    cell = seg * n_step + nmat[:, 0]
+    counts = np.bincount(cell, minlength=n_seg * n_step)
+
+    # rank of every note among the notes of its cell, in input order
+    order = np.argsort(cell, kind="stable")
+    cell_sorted = cell[order]
+    rank = np.arange(len(order)) - np.searchsorted(cell_sorted, cell_sorted)
+
+    # FIXME: when more than `max_note_count` notes are played in one step
+    last_slot = max_note_count - 1
+    overflow = rank >= last_slot - 1
+    if overflow.any():
+        print(f"more than max_note_count {max_note_count} occur!")
+    # overflowing notes share the last slot, only the latest one survives
+    keep = ~overflow | (rank == counts[cell_sorted] - 1)
+    note_ind = order[keep]
+    slot = np.minimum(rank[keep] + 1, last_slot)
+
+    o, p, d = nmat[note_ind].T
+    pnotree[seg[note_ind], o, slot, 0] = p - min_pitch
+    pnotree[seg[note_ind], o, slot, 1 :] = DUR_BITS[np.clip(d, 0, 32)]
+
+    cur_idx = np.minimum(counts + 1, last_slot).reshape(n_seg, n_step)
+    seg_ind, step_ind = np.indices((n_seg, n_step))
+    pnotree[seg_ind, step_ind, cur_idx, 0] = pitch_eos_ind
     return pnotree
 
 
@@ -117,6 +176,30 @@ def pianotree_pitch_shift(pnotree, shift):
     return pnotree
 
 
+def pianotree_batch_pitch_shift(pnotree, shifts):
+    """
+    Transpose a batch of pianotrees (B, 32, 20, 6) on its own device,
+    the b-th segment by shifts[b]. Only pitches (< 128) are shifted.
+    """
+    pitch = pnotree[:, :, :, 0]
+    is_pitch = pitch < 128
+    pnotree = pnotree.clone()
+    pnotree[:, :, :, 0] = pitch + shifts.view(-1, 1, 1) * is_pitch
+    return pnotree
+
+
+def pianotree_pitch_bounds(pnotree):
+    """
+    Return the lowest and highest pitch (B,) of each pianotree of a batch.
+    Segments without notes get (128, -1).
+    """
+    pitch = pnotree[:, :, :, 0].flatten(1)
+    is_pitch = pitch < 128
+    lowest = pitch.masked_fill(~is_pitch, 128).min(dim=1)[0]
+    highest = pitch.masked_fill(~is_pitch, -1).max(dim=1)[0]
+    return lowest, highest
+
+
 def pr_mat_pitch_shift(pr_mat, shift):
     pr_mat = pr_mat.copy()
     pr_mat = np.roll(pr_mat, shift, -1)
@@ -164,48 +247,244 @@ def nmat_to_rhy_array(nmat, n_step=32):
     return pr_mat
 
 
+def estx_to_notes(est_x, seg_offset=0):
+    """
+    The notes of est_x (#, 32, max_note_count, 6) as arrays, in the order of
+    `estx_to_midi_file`: pitch (int), start and end (float, seconds at 120 bpm).
+    Keys with a pitch outside 0-127 (sos, eos, pad) are rests. est_x starts at
+    segment seg_offset of the song.
+    """
+    est_x = np.asarray(est_x)
+    if est_x.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+    seg_inds, step_inds, key_inds = np.nonzero(
+        (est_x[..., 0] >= 0) & (est_x[..., 0] <= 127)
+    )
+    keys = est_x[seg_inds, step_inds, key_inds].astype(np.int64)
+    dur = (
+        keys[:, 5] + (keys[:, 4] << 1) + (keys[:, 3] << 2) + (keys[:, 2] << 3) +
+        (keys[:, 1] << 4) + 1
+    )
+    t = (seg_inds + seg_offset) * 4
+    start = t + step_inds * (1 / 8)
+    end = np.minimum(t + (step_inds + dur) * (1 / 8), t + 4)
+    return keys[:, 0], start, end
+
+
+# the defaults of pretty_midi.PrettyMIDI: ticks per beat at 120 bpm
+MIDI_RESOLUTION = 220
+MIDI_TEMPO = 500000  # microseconds per beat
+_TICK_SCALE = 60.0 / (120.0 * MIDI_RESOLUTION)
+_END_OF_TRACK = b"\x01\xff\x2f\x00"  # 1 tick after the last event
+_PROGRAM_CHANGE = b"\x00\xc0\x00"  # program_change to 0 on channel 0
+
+
+def _time_to_tick(time):
+    """pretty_midi's time_to_tick under the default tempo, of a time array"""
+    return np.round(np.asarray(time, dtype=np.float64) / _TICK_SCALE).astype(np.int64)
+
+
+def _track_chunk(data):
+    return b"MTrk" + struct.pack(">I", len(data)) + bytes(data)
+
+
+def _varlen_columns(values):
+    """
+    MIDI variable-length quantities of values (< 2**28) as 4 byte columns, most
+    significant first, and a mask of the bytes to keep.
+    """
+    cols = np.stack([(values >> shift) & 0x7f for shift in (21, 14, 7, 0)], axis=1)
+    cols[:, : 3] |= 0x80
+    num_bytes = 1 + (values >= 1 << 7) + (values >= 1 << 14) + (values >= 1 << 21)
+    keep = np.arange(4, 0, -1) <= num_bytes[:, None]
+    return cols, keep
+
+
+def _varlen_bytes(value):
+    cols, keep = _varlen_columns(np.array([value], dtype=np.int64))
+    return cols[keep].astype(np.uint8).tobytes()
+
+
+def _timing_track_data(labels=None):
+    """The timing track of pretty_midi: set_tempo, time_signature and lyrics"""
+    timing = [
+        (0, 1, mido.MetaMessage("set_tempo", tempo=MIDI_TEMPO).bytes()),
+        (0, 2, mido.MetaMessage("time_signature", numerator=4, denominator=4).bytes()),
+    ]
+    if labels is not None:
+        for i, label in enumerate(labels):
+            tick = int(_time_to_tick(i * 4))
+            timing.append((tick, 4, mido.MetaMessage("lyrics", text=label).bytes()))
+    timing.sort(key=lambda event: event[: 2])
+    timing_data = bytearray()
+    tick = 0
+    for event_tick, _, msg_bytes in timing:
+        timing_data.extend(_varlen_bytes(event_tick - tick))
+        timing_data.extend(msg_bytes)
+        tick = event_tick
+    timing_data.extend(_END_OF_TRACK)
+    return timing_data
+
+
+def _note_events(pitch, start, end):
+    """
+    The note on/off events of the note arrays as ticks, notes and velocities, in
+    pretty_midi's order: by tick, then by pitch with offs first, then by insertion.
+    """
+    pitch = np.asarray(pitch, dtype=np.int64)
+    ticks = np.stack([_time_to_tick(start), _time_to_tick(end)], axis=1).reshape(-1)
+    notes = np.repeat(pitch, 2)
+    velocity = np.tile(np.array([80, 0]), len(pitch))
+    return _sort_note_events(ticks, notes, velocity)
+
+
+def _sort_note_events(ticks, notes, velocity):
+    order = np.lexsort((notes * 256 + velocity, ticks))
+    return ticks[order], notes[order], velocity[order]
+
+
+def _note_event_bytes(ticks, notes, velocity, prev_tick=0, status=True):
+    """
+    The sorted note events following an event at prev_tick, in running status: only
+    the first event has its status byte, if status.
+    """
+    deltas = np.diff(ticks, prepend=prev_tick)
+    cols, keep = _varlen_columns(deltas)
+    status_bytes = np.zeros(len(ticks), dtype=np.int64)
+    status_bytes[: 1] = 0x90 if status else 0
+    events = np.concatenate(
+        [cols, status_bytes[:, None], notes[:, None], velocity[:, None]], axis=1
+    )
+    keep = np.concatenate(
+        [keep, (status_bytes > 0)[:, None], np.ones((len(ticks), 2), dtype=bool)],
+        axis=1
+    )
+    return events[keep].astype(np.uint8).tobytes()
+
+
+def _midi_header():
+    return b"MThd" + struct.pack(">Ihhh", 6, 1, 2, MIDI_RESOLUTION)
+
+
+def notes_to_midi_bytes(pitch, start, end, labels=None):
+    """
+    The MIDI file that pretty_midi writes for the note arrays of `estx_to_notes` as
+    one piano track (velocity 80) and labels as lyrics every 4 seconds, byte for
+    byte, but encoded with NumPy instead of one mido message per event.
+    """
+    piano_data = bytearray(_PROGRAM_CHANGE)
+    piano_data.extend(_note_event_bytes(*_note_events(pitch, start, end)))
+    piano_data.extend(_END_OF_TRACK)
+    return (
+        _midi_header() + _track_chunk(_timing_track_data(labels)) +
+        _track_chunk(piano_data)
+    )
+
+
+class MidiStreamWriter:
+    """
+    Builds the MIDI file of `notes_to_midi_file` incrementally, from notes appended
+    in time order. Events that later notes cannot precede are written as soon as
+    they are known; after every append the file is a complete MIDI of the notes so
+    far, and after close it is byte for byte the file of all notes at once.
+    labels (lyrics) go to the timing track and so must be known up front.
+    """
+
+    def __init__(self, fpath, labels=None):
+        self.file = open(fpath, "wb")
+        self.file.write(_midi_header() + _track_chunk(_timing_track_data(labels)))
+        self.file.write(b"MTrk\x00\x00\x00\x00")
+        self.track_start = self.file.tell()
+        self.file.write(_PROGRAM_CHANGE)
+        # the events written for good end at committed, the last at tick
+        self.committed = self.file.tell()
+        self.tick = 0
+        self.status = True
+        self.pending = (np.zeros(0, dtype=np.int64), ) * 3
+        self.num_segs = 0
+        self._write_pending()
+
+    def append(self, pitch, start, end, until=None):
+        """
+        Append the note arrays of `estx_to_notes`. until (seconds) is the earliest
+        start of the notes to come, all of them if None.
+        """
+        events = _note_events(pitch, start, end)
+        ticks, notes, velocity = _sort_note_events(
+            *(np.concatenate(pair) for pair in zip(self.pending, events))
+        )
+        n = len(ticks) if until is None else np.searchsorted(
+            ticks, _time_to_tick(until)
+        )
+        if n > 0:
+            self.file.seek(self.committed)
+            self.file.write(
+                _note_event_bytes(
+                    ticks[: n], notes[: n], velocity[: n], self.tick, self.status
+                )
+            )
+            self.committed = self.file.tell()
+            self.tick = ticks[n - 1]
+            self.status = False
+        self.pending = ticks[n :], notes[n :], velocity[n :]
+        self._write_pending()
+
+    def append_estx(self, est_x):
+        """Append est_x (#, 32, max_note_count, 6), the segments after the last"""
+        notes = estx_to_notes(est_x, self.num_segs)
+        self.num_segs += len(est_x)
+        self.append(*notes, until=self.num_segs * 4)
+
+    def _write_pending(self):
+        """Close the track with the pending events, to be rewritten by append"""
+        self.file.seek(self.committed)
+        self.file.write(_note_event_bytes(*self.pending, self.tick, self.status))
+        self.file.write(_END_OF_TRACK)
+        self.file.truncate()
+        end = self.file.tell()
+        self.file.seek(self.track_start - 4)
+        self.file.write(struct.pack(">I", end - self.track_start))
+        self.file.seek(end)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def notes_to_midi_file(pitch, start, end, fpath, labels=None):
+    """Write the note arrays of `estx_to_notes` as a MIDI file"""
+    with open(fpath, "wb") as f:
+        f.write(notes_to_midi_bytes(pitch, start, end, labels))
+
+
 def estx_to_midi_file(est_x, fpath, labels=None):
-    # print(f"est_x with shape {est_x.shape} to midi file {fpath}")  # (#, 32, 15, 6)
-    # pr_mat3d is a (32, max_note_count, 6) matrix. In the last dim,
+    # est_x is a (#, 32, max_note_count, 6) matrix. In the last dim,
     # the 0th column is for pitch, 1: 6 is for duration in binary repr. Output is
     # padded with <sos> and <eos> tokens in the pitch column, but with pad token
     # for dur columns.
-    midi = pm.PrettyMIDI()
-    piano_program = pm.instrument_name_to_program("Acoustic Grand Piano")
-    piano = pm.Instrument(program=piano_program)
-    t = 0
-    for two_bar_ind, two_bars in enumerate(est_x):
-        for step_ind, step in enumerate(two_bars):
-            for kth_key in step:
-                assert len(kth_key) == 6
-                if not (kth_key[0] >= 0 and kth_key[0] <= 127):
-                    # rest key
-                    # print(f"({two_bar_ind}, {step_ind}, somekey, 0): {kth_key[0]}")
-                    continue
-
-                # print(f"({two_bar_ind}, {step_ind}, somekey, 0): {kth_key[0]}")
-                dur = (
-                    kth_key[5] + (kth_key[4] << 1) + (kth_key[3] << 2) +
-                    (kth_key[2] << 3) + (kth_key[1] << 4) + 1
-                )
-                note = pm.Note(
-                    velocity=80,
-                    pitch=int(kth_key[0]),
-                    start=t + step_ind * 1 / 8,
-                    end=min(t + (step_ind + int(dur)) * 1 / 8, t + 4),
-                )
-                piano.notes.append(note)
-        t += 4
-    midi.instruments.append(piano)
+    notes_to_midi_file(*estx_to_notes(est_x), fpath, labels)
+
+
+def _estx_to_midi_file(args):
+    estx_to_midi_file(*args)
 
-    if labels is not None:
-        midi.lyrics.clear()
-        t = 0
-        for label in labels:
-            midi.lyrics.append(pm.Lyric(label, t))
-            t += 4
 
-    midi.write(fpath)
+def estx_to_midi_files(est_xs, fpaths, labels=None, num_workers=None):
+    """
+    `estx_to_midi_file` of every est_x in est_xs to the fpath in fpaths (and
+    labels, if given), by a pool of num_workers processes (all CPUs if None).
+    """
+    if labels is None:
+        labels = [None] * len(fpaths)
+    jobs = list(zip(est_xs, fpaths, labels))
+    with ProcessPoolExecutor(num_workers) as executor:
+        list(executor.map(_estx_to_midi_file, jobs, chunksize=4))
 
 
 if __name__ == "__main__":